@@ -0,0 +1,40 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Fused analysis: runs the Rekognition step of each image and one ProcessFaces pass in
+# this process instead of through the state machine. The function is deployed
+# with the whole lambdas/ directory so both handlers are imported unchanged.
+import logging
+import os
+from aws_embedded_metrics import metric_scope
+from tracing import parallel
+
+from rekognition import index as rekognition
+from processFaces import index as process_faces
+
+ANALYSIS_CONCURRENCY = int(os.getenv('ANALYSIS_CONCURRENCY', '10'))
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+def Analyze(image, context):
+    """Run the Rekognition step of one image, failures are reported like the state machine does."""
+    try:
+        return rekognition.analyse(image, context)
+
+    except Exception as e:
+        logger.error('Something went wrong: ' + str(e))
+        return {'result': 'Fail', 'msg': str(e)}
+
+@metric_scope
+def handler(event, context, metrics):
+    images = event["images"] if "images" in event else [event]
+    # 0 means no limit, as for the MaxConcurrency of the Map state
+    workers = ANALYSIS_CONCURRENCY if ANALYSIS_CONCURRENCY > 0 else len(images)
+    results = parallel(lambda image: Analyze(image, context), images, workers)
+    # the limiters are shared by the threads, their stats cover all images
+    rekognition.publish_limits(metrics)
+
+    logger.info("Analysed %d images: %s", len(results), [r['result'] for r in results])
+    # one ProcessFaces pass over all results so Comprehend calls are batched
+    return process_faces.handler(results, context)
@@ -2,12 +2,17 @@
 # SPDX-License-Identifier: MIT-0
 from datetime import datetime
 from datetime import timedelta
+import codecs
+import csv
+import hashlib
 import json
-import urllib
+import urllib.parse
 import boto3
 import logging
 import time
 import os
+from aws_embedded_metrics import metric_scope
+from cache import LRUCache
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 
@@ -15,16 +20,135 @@ patch_all()
 
 BUCKET_NAME = os.getenv('BUCKET_NAME')
 DATABASE_NAME = os.getenv('DATABASE_NAME')
+QUERY_CACHE_TTL = int(os.getenv('QUERY_CACHE_TTL', '60'))
+RESULT_REUSE_MINUTES = int(os.getenv('RESULT_REUSE_MINUTES', '1'))
+POLL_FIRST_DELAY = 0.1
+POLL_MAX_DELAY = 2.0
+CACHE_PREFIX = 'cache/athena/'
+STREAM_ROW_LIMIT = int(os.getenv('STREAM_ROW_LIMIT', '10000'))
+STREAM_CHUNK_BYTES = int(os.getenv('STREAM_CHUNK_BYTES', str(1024 * 1024)))
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 s3_output =  's3://' + BUCKET_NAME + '/twitter-ath-results/'
 ath = boto3.client('athena')
+s3 = boto3.client('s3')
+results_paginator = ath.get_paginator('get_query_results')
+query_cache = LRUCache(256)
 timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+def QueryKey(query_string, emotion):
+    """Hash of the query with its whitespace normalized, and of the result location."""
+    normalized = ' '.join(query_string.split())
+    return hashlib.sha256((emotion + '\n' + normalized).encode('utf-8')).hexdigest()
+
+def GetCachedResults(key):
+    cached = query_cache.get(key)
+    if cached is not None and cached[0] > time.time():
+        return cached[1], 'memory'
+    try:
+        body = json.loads(s3.get_object(Bucket=BUCKET_NAME, Key=CACHE_PREFIX + key + '.json')['Body'].read())
+    except s3.exceptions.NoSuchKey:
+        return None, None
+    except Exception as e:
+        logger.error('Query cache lookup failed: ' + str(e))
+        return None, None
+    if body['expires_at'] <= time.time():
+        return None, None
+    query_cache.put(key, (body['expires_at'], body['results']))
+    return body['results'], 's3'
+
+def PutCachedResults(key, results, ttl):
+    expires_at = time.time() + ttl
+    query_cache.put(key, (expires_at, results))
+    try:
+        s3.put_object(
+            ACL='private',
+            Body=json.dumps({'expires_at': expires_at, 'results': results}),
+            Bucket=BUCKET_NAME,
+            Key=CACHE_PREFIX + key + '.json'
+        )
+    except Exception as e:
+        logger.error('Query cache write failed: ' + str(e))
+
+def _typed(athena_type):
+    if athena_type in ('tinyint', 'smallint', 'integer', 'bigint'):
+        return int
+    if athena_type in ('double', 'float', 'real', 'decimal'):
+        return float
+    if athena_type == 'boolean':
+        return lambda value: value == 'true'
+    return None
+
+def _lines(bucket, key, size, chunk_bytes):
+    """Yield the lines of an S3 object, reading it in byte ranges of chunk_bytes."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = ''
+    for start in range(0, size, chunk_bytes):
+        end = min(start + chunk_bytes, size) - 1
+        body = s3.get_object(Bucket=bucket, Key=key, Range='bytes=%d-%d' % (start, end))['Body'].read()
+        lines = (pending + decoder.decode(body)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    pending = pending + decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+def StreamResults(execution, row_limit=None, chunk_bytes=None):
+    """Yield the rows of a finished query as typed dicts, read from its CSV output in S3.
+
+    Only one byte range of the output is held in memory at a time. Numbers
+    and booleans are converted from the column types of the result, empty
+    values of those columns become None, other columns stay strings.
+    """
+    chunk_bytes = chunk_bytes or STREAM_CHUNK_BYTES
+    columns = ath.get_query_results(
+        QueryExecutionId=execution['QueryExecutionId'], MaxResults=1
+    )['ResultSet']['ResultSetMetadata']['ColumnInfo']
+    names = [column['Name'] for column in columns]
+    converters = [_typed(column['Type']) for column in columns]
+
+    location = urllib.parse.urlparse(execution['ResultConfiguration']['OutputLocation'])
+    bucket, key = location.netloc, location.path.lstrip('/')
+    size = s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+
+    rows = csv.reader(_lines(bucket, key, size, chunk_bytes))
+    next(rows, None)  # header
+    for count, values in enumerate(rows):
+        if row_limit is not None and count >= row_limit:
+            return
+        row = {}
+        for name, convert, value in zip(names, converters, values):
+            if convert is not None:
+                value = convert(value) if value != '' else None
+            row[name] = value
+        yield row
+
+def ReadResults(query_id):
+    """Return all rows of a finished query as dicts of strings, from the results API."""
+    results_iter = results_paginator.paginate(
+        QueryExecutionId=query_id,
+        PaginationConfig={
+            'PageSize': 1000
+        }
+    )
+    results = []
+    column_names = None
+    for results_page in results_iter:
+        for row in results_page['ResultSet']['Rows']:
+           column_values = [col.get('VarCharValue', None) for col in row['Data']]
+           if not column_names:
+               column_names = column_values
+           else:
+               results.append(dict(zip(column_names, column_values)))
+    
+    return results
+
 @xray_recorder.capture('## AthQuery')
-def AthenaQuery(query_string, emotion):
+def AthenaQuery(query_string, emotion, stats, row_limit=None):
+    """Run the query and return its rows, streamed from the CSV output when row_limit is set."""
     xray_recorder.put_annotation('Query', query_string)
     query_id = ath.start_query_execution(
         QueryString=query_string,
@@ -33,35 +157,57 @@ def AthenaQuery(query_string, emotion):
         },
         ResultConfiguration={
             'OutputLocation': s3_output + emotion
+        },
+        ResultReuseConfiguration={
+            'ResultReuseByAgeConfiguration': {
+                'Enabled': RESULT_REUSE_MINUTES > 0,
+                'MaxAgeInMinutes': max(1, RESULT_REUSE_MINUTES)
+            }
         }
     )['QueryExecutionId']
-    query_status = None
-    while query_status == 'QUEUED' or query_status == 'RUNNING' or query_status is None:
-        query_status = ath.get_query_execution(QueryExecutionId=query_id)['QueryExecution']['Status']['State']
+    # short first waits for sub-second queries, backing off for long ones
+    delay = POLL_FIRST_DELAY
+    while True:
+        execution = ath.get_query_execution(QueryExecutionId=query_id)['QueryExecution']
+        query_status = execution['Status']['State']
         if query_status == 'FAILED' or query_status == 'CANCELLED':
             raise Exception('Athena query with the string "{}" failed or was cancelled'.format(query_string))
-        time.sleep(2)
-        results_paginator = ath.get_paginator('get_query_results')
-        results_iter = results_paginator.paginate(
-            QueryExecutionId=query_id,
-            PaginationConfig={
-                'PageSize': 1000
-            }
-        )
-    results = []
-    column_names = None
-    for results_page in results_iter:
-        for row in results_page['ResultSet']['Rows']:
-           column_values = [col.get('VarCharValue', None) for col in row['Data']]
-           if not column_names:
-               column_names = column_values
-           else:
-               results.append(dict(zip(column_names, column_values)))
-    
-    return results
+        if query_status == 'SUCCEEDED':
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, POLL_MAX_DELAY)
+
+    statistics = execution.get('Statistics', {})
+    stats['queue_ms'] = statistics.get('QueryQueueTimeInMillis', 0)
+    stats['execution_ms'] = statistics.get('EngineExecutionTimeInMillis', 0)
+    stats['reused'] = statistics.get('ResultReuseInformation', {}).get('ReusedPreviousResult', False)
+
+    if row_limit is not None:
+        return list(StreamResults(execution, row_limit))
+    return ReadResults(query_id)
         
-def handler(event, context):
-    
-        res = AthenaQuery(event["query"], event["type"])
+@metric_scope
+def handler(event, context, metrics):
+        ttl = int(event.get("cache_ttl", QUERY_CACHE_TTL))
+        key = QueryKey(event["query"], event["type"])
+        stats = {}
+        # streamed results are typed and capped, they are cached apart from paginated ones
+        row_limit = int(event.get("row_limit", STREAM_ROW_LIMIT)) if event.get("stream") else None
+        if row_limit is not None:
+            key = QueryKey(event["query"], event["type"] + '#stream#%d' % row_limit)
+        res, source = GetCachedResults(key) if ttl > 0 else (None, None)
+        if res is None:
+            res = AthenaQuery(event["query"], event["type"], stats, row_limit)
+            if ttl > 0:
+                PutCachedResults(key, res, ttl)
+
+        metrics.set_namespace('TwitterRekognition')
+        metrics.put_metric("QueryCacheHits", 1 if source else 0, "Count")
+        metrics.put_metric("QueryCacheMisses", 0 if source else 1, "Count")
+        if stats:
+            metrics.put_metric("AthenaQueueTime", stats['queue_ms'], "Milliseconds")
+            metrics.put_metric("AthenaExecutionTime", stats['execution_ms'], "Milliseconds")
+            metrics.put_metric("AthenaResultsReused", 1 if stats['reused'] else 0, "Count")
+        metrics.set_property("payload", dict(stats, type=event["type"], cache=source or 'miss', rows=len(res)))
         logger.debug(res)
-        return res
\ No newline at end of file
+        return res
@@ -8,6 +8,7 @@ import boto3
 import logging
 import time
 import os
+from emotionindex import EmotionIndex
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 
@@ -15,6 +16,9 @@ patch_all()
 
 BUCKET_NAME = os.getenv('BUCKET_NAME')
 FIREHOSE_NAME = os.getenv('FIREHOSE_NAME')
+EMOTION_INDEX_TABLE = os.getenv('EMOTION_INDEX_TABLE')
+EMOTION_INDEX_SIZE = int(os.getenv('EMOTION_INDEX_SIZE', '100'))
+EMOTION_INDEX_MIN_CONFIDENCE = float(os.getenv('EMOTION_INDEX_MIN_CONFIDENCE', '50'))
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -23,6 +27,7 @@ print('Loading function')
 
 client = boto3.client('s3')
 s3 = boto3.resource('s3')
+emotion_index = EmotionIndex(EMOTION_INDEX_TABLE, size=EMOTION_INDEX_SIZE, min_confidence=EMOTION_INDEX_MIN_CONFIDENCE) if EMOTION_INDEX_TABLE else None
 
 payload = {}
 
@@ -39,6 +44,9 @@ def handler(event, context):
         tweet = body["tweet"]
         dt = datetime.fromisoformat(tweet["updated_at"])
         
+        if emotion_index is not None:
+            emotion_index.remove(tweet["face_id"])
+
         s3_key = "parquet-" + str(today.year) + "/"
 
         name_updated_at = s3_key + FIREHOSE_NAME + "-1-" + dt.strftime("%Y-%m-%d-%H")
@@ -9,6 +9,8 @@ import logging
 import csv
 import os
 import base64
+from emotionindex import EmotionIndex
+from faceschema import EMOTION_TYPES
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 
@@ -16,11 +18,15 @@ patch_all()
 
 BUCKET_NAME = os.getenv('BUCKET_NAME')
 AthQueryLambdaName = os.getenv('AthQueryLambdaName')
+EMOTION_INDEX_TABLE = os.getenv('EMOTION_INDEX_TABLE')
+EMOTION_INDEX_SIZE = int(os.getenv('EMOTION_INDEX_SIZE', '100'))
+EMOTION_INDEX_MIN_CONFIDENCE = float(os.getenv('EMOTION_INDEX_MIN_CONFIDENCE', '50'))
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 lambda_client = boto3.client('lambda')
+emotion_index = EmotionIndex(EMOTION_INDEX_TABLE, size=EMOTION_INDEX_SIZE, min_confidence=EMOTION_INDEX_MIN_CONFIDENCE) if EMOTION_INDEX_TABLE else None
 
 def _response_proxy(status_code, body, headers={}):
     if bool(headers): # Return True if dictionary is not empty
@@ -28,8 +34,81 @@ def _response_proxy(status_code, body, headers={}):
     else:
         return {"statusCode": status_code, "body": json.dumps(body)}
 
+@xray_recorder.capture('## Sample Emotion Index')
+def SampleIndex(emotion):
+    if emotion_index is None:
+        return None
+    try:
+        return emotion_index.sample(emotion)
+    except Exception as e:
+        logger.error('Emotion index lookup failed: ' + str(e))
+        return None
+
+def _query_athena(emotion_type, query_str):
+    payload = {}
+    payload["type"] = emotion_type
+    payload["query"] = query_str
+
+    response = lambda_client.invoke(
+        FunctionName=AthQueryLambdaName,
+        InvocationType='RequestResponse',
+        Payload=json.dumps(payload)
+    )
+    
+    return json.loads(response['Payload'].read())
+
+def _top_face_query(emotion):
+    """Athena query of the face with the highest confidence of an emotion type."""
+    column = 'emotion_' + emotion.lower()
+    return """
+        select face_id, image_url, first_name, last_name, (agerange.low + agerange.high)/2 as age, 
+        gender.value as gender_value, '%s' as etype, 
+        round(%s,3) as confidence, full_text,
+        bbox_left, bbox_top, bbox_width, bbox_height,
+        imgWidth, imgHeight, sentiment, updated_at
+        from parquet_records TABLESAMPLE BERNOULLI (50)
+        where %s is not null
+        order by %s desc
+        LIMIT 1
+    """ % (emotion, column, column, column)
+
+def GetImages(event):
+    """Answer /images?emotions=A,B with one face per emotion, from the index or a single Athena query."""
+    headers = {
+       'Content-Type': 'application/json', 
+       'Access-Control-Allow-Origin': '*' 
+    }
+
+    emotions = [e.strip().upper() for e in event["queryStringParameters"]["emotions"].split(',') if e.strip()]
+    unknown = [e for e in emotions if e not in EMOTION_TYPES]
+    if unknown or not emotions:
+        return _response_proxy(400, {'result': False, 'msg': 'Unknown emotions: ' + ','.join(unknown)}, headers)
+
+    images = {}
+    for emotion in emotions:
+        item = SampleIndex(emotion)
+        if item is not None:
+            images[emotion] = item
+
+    missing = [emotion for emotion in emotions if emotion not in images]
+    if missing:
+        # one ranking per emotion column, each reads only its own column to filter and sort
+        query_str = '\n        union all\n'.join('(%s)' % _top_face_query(emotion) for emotion in missing)
+
+        for row in _query_athena('batch', query_str):
+            images[row['etype']] = row
+
+    logger.info('Images for %s, %d from Athena', emotions, len(missing))
+    return _response_proxy(200, images, headers)
+
 def handler(event, context):
     try:   
+        if event.get("rawPath", "").endswith('/images'):
+            if 'emotions' not in event.get("queryStringParameters", {}):
+                logger.error( 'Missing parameters')
+                return {'result': False, 'msg': 'Missing parameters' }
+            return GetImages(event)
+
         if 'emotion' not in event["queryStringParameters"]:
             logger.error( 'Missing parameters')
             return {'result': False, 'msg': 'Missing parameters' }
@@ -37,40 +116,25 @@ def handler(event, context):
         print(event["queryStringParameters"]["emotion"])
         emotion = event["queryStringParameters"]["emotion"]
 
-        query_str = """
-        with twitter_emotions as (
-            select face_id, image_url, first_name, last_name, (agerange.low + agerange.high)/2 as age, 
-            gender.value as gender_value, emotion.type as etype, 
-            round(emotion.confidence,3) as confidence, full_text,
-            bbox_left, bbox_top, bbox_width, bbox_height,
-            imgWidth, imgHeight, sentiment, updated_at
-            from parquet_records TABLESAMPLE BERNOULLI (50)
-            cross JOIN UNNEST(emotions) as t(emotion)
-            where emotion.type = '%s'
-            order by confidence desc
-            LIMIT 1
-        )
-        select * from twitter_emotions           
-        """ % (emotion)
-
-        payload = {}
-        payload["type"] = emotion
-        payload["query"] = query_str
-
-        response = lambda_client.invoke(
-            FunctionName=AthQueryLambdaName,
-            InvocationType='RequestResponse',
-            Payload=json.dumps(payload)
-        )
-        
-        data = json.loads(response['Payload'].read())
-        
-        logger.info(data[0])
-        
         headers = {
            'Content-Type': 'application/json', 
            'Access-Control-Allow-Origin': '*' 
         }
+
+        # the emotion names a column of the query
+        if emotion not in EMOTION_TYPES:
+            return _response_proxy(400, {'result': False, 'msg': 'Unknown emotion: ' + emotion}, headers)
+
+        # served from the index processFaces maintains, Athena only when it is empty
+        item = SampleIndex(emotion)
+        if item is not None:
+            return _response_proxy(200, item, headers)
+
+        data = _query_athena(emotion, _top_face_query(emotion))
+        if not data:
+            return _response_proxy(404, {'result': False, 'msg': 'No face found for ' + emotion}, headers)
+        
+        logger.info(data[0])
         
         return _response_proxy(200, data[0], headers)
         
@@ -3,6 +3,7 @@ from crhelper import CfnResource
 import logging
 import boto3
 from datetime import datetime
+from faceschema import EMOTION_TYPES
 
 # https://github.com/aws-cloudformation/custom-resource-helper
 
@@ -17,6 +18,136 @@ except Exception as e:
     helper.init_failure(e)
 
 
+RECORD_COLUMNS = [
+    {
+        "Name": "first_name",
+        "Type": "string"
+    },
+    {
+        "Name": "last_name",
+        "Type": "string"
+    },
+    {
+        "Name": "image_url",
+        "Type": "string"
+    },
+    {
+        "Name": "tweet_id",
+        "Type": "string"
+    },
+    {
+        "Name": "gender",
+        "Type": "struct<value:string,confidence:double>"
+    },
+    {
+        "Name": "face_id",
+        "Type": "string"
+    },
+    {
+        "Name": "emotions",
+        "Type": "array<struct<type:string,confidence:double>>"
+    },
+    {
+        "Name": "bbox_left",
+        "Type": "double"
+    },
+    {
+        "Name": "bbox_top",
+        "Type": "double"
+    },
+    {
+        "Name": "bbox_width",
+        "Type": "double"
+    },
+    {
+        "Name": "bbox_height",
+        "Type": "double"
+    },
+    {
+        "Name": "imgwidth",
+        "Type": "int"
+    },
+    {
+        "Name": "imgheight",
+        "Type": "int"
+    },
+    {
+        "Name": "full_text",
+        "Type": "string"
+    },
+    {
+        "Name": "sentiment",
+        "Type": "string"
+    },
+    {
+        "Name": "updated_at",
+        "Type": "string"
+    },
+    {
+        "Name": "agerange",
+        "Type": "struct<low:int,high:int>"
+    },
+    {
+        "Name": "dominant_emotion",
+        "Type": "string"
+    },
+    {
+        "Name": "dominant_confidence",
+        "Type": "double"
+    }
+] + [
+    # one confidence column per Rekognition emotion type, null when absent
+    {
+        "Name": "emotion_" + emotionType.lower(),
+        "Type": "double"
+    }
+    for emotionType in EMOTION_TYPES
+]
+
+
+def JsonTableInput(bucketName, outputMode):
+    """Table over the face records processFaces writes under data/json-records/."""
+    compressed = outputMode == 'ndjson-gzip'
+    parameters = {'classification': 'json'}
+    if compressed:
+        parameters['compressionType'] = 'gzip'
+    return {
+        'Name':  'json_records',
+        'Parameters': parameters,
+        'StorageDescriptor': {
+            'Columns': RECORD_COLUMNS,
+            'Location': 's3://' + bucketName + '/data/json-records/',
+            'InputFormat': 'org.apache.hadoop.mapred.TextInputFormat',
+            'OutputFormat': 'org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat',
+            'Compressed': compressed,
+            'NumberOfBuckets': 0,
+            'SerdeInfo': {
+                'SerializationLibrary': 'org.openx.data.jsonserde.JsonSerDe'
+            },
+        },
+        'TableType': 'EXTERNAL_TABLE'
+    }
+
+
+def ParquetTableInput(bucketName, location=None):
+    """Table over the parquet files the Firehose delivery stream writes."""
+    return {
+        'Name':  'parquet_records',
+        'StorageDescriptor': {
+            'Columns': RECORD_COLUMNS,
+            'Location': location or 's3://' + bucketName + '/data/parquet-' + datetime.now().strftime("%Y"),
+            'InputFormat': 'org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat',
+            'OutputFormat': 'org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat',
+            'Compressed': False,
+            'NumberOfBuckets': 0,
+            'SerdeInfo': {
+                'SerializationLibrary': 'org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe'
+            },
+        },
+        'TableType': 'EXTERNAL_TABLE'
+    }
+
+
 @helper.create
 def create(event, context):
     logger.info("Got Create")
@@ -39,179 +170,13 @@ def create(event, context):
         ) 
 
     response = glue.create_table(
-    DatabaseName=databaseName,
-    TableInput={
-        'Name':  'json_records',
-        'StorageDescriptor': {
-            'Columns': [ 
-                {
-                    "Name": "first_name",
-                    "Type": "string"
-                },
-                {
-                    "Name": "last_name",
-                    "Type": "string"
-                },
-                {
-                    "Name": "image_url",
-                    "Type": "string"
-                },
-                {
-                    "Name": "tweet_id",
-                    "Type": "string"
-                },
-                {
-                    "Name": "gender",
-                    "Type": "struct<value:string,confidence:double>"
-                },
-                {
-                    "Name": "face_id",
-                    "Type": "string"
-                },
-                {
-                    "Name": "emotions",
-                    "Type": "array<struct<type:string,confidence:double>>"
-                },
-                {
-                    "Name": "bbox_left",
-                    "Type": "double"
-                },
-                {
-                    "Name": "bbox_top",
-                    "Type": "double"
-                },
-                {
-                    "Name": "bbox_width",
-                    "Type": "double"
-                },
-                {
-                    "Name": "bbox_height",
-                    "Type": "double"
-                },
-                {
-                    "Name": "imgwidth",
-                    "Type": "int"
-                },
-                {
-                    "Name": "imgheight",
-                    "Type": "int"
-                },
-                {
-                    "Name": "full_text",
-                    "Type": "string"
-                },
-                {
-                    "Name": "sentiment",
-                    "Type": "string"
-                },
-                {
-                    "Name": "updated_at",
-                    "Type": "string"
-                },
-                {
-                    "Name": "agerange",
-                    "Type": "struct<low:int,high:int>"
-                }
-            ],
-        'Location': 's3://' + bucketName + '/data/json-records/',
-        'InputFormat': 'org.apache.hadoop.mapred.TextInputFormat',
-        'OutputFormat': 'org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat',
-        'Compressed': False,
-        'NumberOfBuckets': 0,
-        'SerdeInfo': {
-            'SerializationLibrary': 'org.openx.data.jsonserde.JsonSerDe'
-        },
-        },
-        'TableType': 'EXTERNAL_TABLE'
-        }
-    )  
+        DatabaseName=databaseName,
+        TableInput=JsonTableInput(bucketName, event['ResourceProperties'].get('OutputMode', 'objects'))
+    )
 
     response = glue.create_table(
-    DatabaseName=databaseName,
-    TableInput={
-        'Name':  'parquet_records',
-        'StorageDescriptor': {
-            'Columns': [ 
-                {
-                    "Name": "first_name",
-                    "Type": "string"
-                },
-                {
-                    "Name": "last_name",
-                    "Type": "string"
-                },
-                {
-                    "Name": "image_url",
-                    "Type": "string"
-                },
-                {
-                    "Name": "tweet_id",
-                    "Type": "string"
-                },
-                {
-                    "Name": "gender",
-                    "Type": "struct<value:string,confidence:double>"
-                },
-                {
-                    "Name": "face_id",
-                    "Type": "string"
-                },
-                {
-                    "Name": "emotions",
-                    "Type": "array<struct<type:string,confidence:double>>"
-                },
-                {
-                    "Name": "bbox_left",
-                    "Type": "double"
-                },
-                {
-                    "Name": "bbox_top",
-                    "Type": "double"
-                },
-                {
-                    "Name": "bbox_width",
-                    "Type": "double"
-                },
-                {
-                    "Name": "bbox_height",
-                    "Type": "double"
-                },
-                {
-                    "Name": "imgwidth",
-                    "Type": "int"
-                },
-                {
-                    "Name": "imgheight",
-                    "Type": "int"
-                },
-                {
-                    "Name": "full_text",
-                    "Type": "string"
-                },
-                {
-                    "Name": "sentiment",
-                    "Type": "string"
-                },
-                {
-                    "Name": "updated_at",
-                    "Type": "string"
-                },
-                {
-                    "Name": "agerange",
-                    "Type": "struct<low:int,high:int>"
-                }
-            ],
-        'Location': 's3://' + bucketName + '/data/parquet-' + datetime.now().strftime("%Y"),
-        'InputFormat': 'org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat',
-        'OutputFormat': 'org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat',
-        'Compressed': False,
-        'NumberOfBuckets': 0,
-        'SerdeInfo': {
-            'SerializationLibrary': 'org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe'
-        },
-        },
-        'TableType': 'EXTERNAL_TABLE'
-        }
+        DatabaseName=databaseName,
+        TableInput=ParquetTableInput(bucketName)
     )
     
     helper.Data['Db'] = databaseName
@@ -226,8 +191,31 @@ def create(event, context):
 @helper.update
 def update(event, context):
     logger.info("Got Update")
+
+    bucketName = event['ResourceProperties']['BucketName']
+    databaseName = event['ResourceProperties']['DatabaseName']
+
+    # keep the json_records table in line with the output mode of processFaces,
+    # and both tables in line with the record columns
+    response = glue.update_table(
+        DatabaseName=databaseName,
+        TableInput=JsonTableInput(bucketName, event['ResourceProperties'].get('OutputMode', 'objects'))
+    )
+
+    # parquet files are read by column name, files written before a column was
+    # added return null for it until they are backfilled
+    location = glue.get_table(
+        DatabaseName=databaseName,
+        Name='parquet_records'
+    )['Table']['StorageDescriptor']['Location']
+    response = glue.update_table(
+        DatabaseName=databaseName,
+        TableInput=ParquetTableInput(bucketName, location)
+    )
+
     # If the update resulted in a new resource being created, return an id for the new resource. 
     # CloudFormation will send a delete event with the old id when stack update completes
+    return event["PhysicalResourceId"]
 
 
 @helper.delete
@@ -7,10 +7,15 @@ import sys
 import boto3
 import base64
 import logging
+from time import sleep
 from aws_embedded_metrics import metric_scope
+from cache import LRUCache, BloomFilter
+from imageprobe import probe
+from tracing import parallel
 from datetime import datetime, timedelta
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.conditions import Attr
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 
@@ -18,88 +23,235 @@ patch_all()
 
 DDB_IMAGE_TABLE = os.getenv('DDB_IMAGE_TABLE')
 STATE_MACHINE_ARN = os.getenv('STATE_MACHINE_ARN')
+ANALYSIS_MODE = os.getenv('ANALYSIS_MODE', 'stepfunctions')
+ANALYZE_FUNCTION_NAME = os.getenv('ANALYZE_FUNCTION_NAME')
+
+BATCH_GET_LIMIT = 100
+BATCH_RETRIES = 5
+CLAIM_CONCURRENCY = int(os.getenv('CLAIM_CONCURRENCY', '10'))
+SFN_BATCH_SIZE = int(os.getenv('SFN_BATCH_SIZE', '40'))
+MIN_IMAGE_WIDTH = int(os.getenv('MIN_IMAGE_WIDTH', '500'))
+
+SEEN_CACHE_SIZE = int(os.getenv('SEEN_CACHE_SIZE', '10000'))
+SEEN_BLOOM_CAPACITY = int(os.getenv('SEEN_BLOOM_CAPACITY', '200000'))
+SEEN_BLOOM_ERROR_RATE = float(os.getenv('SEEN_BLOOM_ERROR_RATE', '0.001'))
+SEEN_BLOOM_PATH = '/tmp/seen-image-urls.bloom'
 
 rek = boto3.client('rekognition')
-dynamodb = boto3.resource("dynamodb")
+sfn = boto3.client('stepfunctions')
+lambda_client = boto3.client('lambda')
+dynamodb = boto3.resource("dynamodb", config=Config(max_pool_connections=CLAIM_CONCURRENCY))
 dyn_table = dynamodb.Table(DDB_IMAGE_TABLE)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Urls this container has already looked up or recorded. The LRU is exact for
+# recent urls, the bloom filter remembers older ones at a small false positive
+# rate and is kept in /tmp so it survives a runtime restart in the same sandbox.
+# Images are recorded for 15 days, so the filter is reset after that.
+seen_urls = LRUCache(SEEN_CACHE_SIZE)
+seen_bloom = BloomFilter(SEEN_BLOOM_CAPACITY, SEEN_BLOOM_ERROR_RATE, max_age=15 * 24 * 3600)
+seen_bloom.load(SEEN_BLOOM_PATH)
+
 @xray_recorder.capture('## GetDynamo')
-def GetImage(url):
+def GetImages(urls):
+    """Return the urls already recorded in the image table and the number of calls made."""
+    found = set()
+    calls = 0
+    for i in range(0, len(urls), BATCH_GET_LIMIT):
+        request = {
+            DDB_IMAGE_TABLE: {
+                'Keys': [{'img_url': str(url)} for url in urls[i:i + BATCH_GET_LIMIT]],
+                'ProjectionExpression': 'img_url'
+            }
+        }
+        retries = 0
+        while request:
+            try:
+                response = dynamodb.batch_get_item(RequestItems=request)
+            except ClientError as e:
+                logger.error(e.response['Error']['Message'])
+                break
+            calls += 1
+            for item in response['Responses'].get(DDB_IMAGE_TABLE, []):
+                found.add(item['img_url'])
+            request = response.get('UnprocessedKeys')
+            if request:
+                retries += 1
+                if retries == BATCH_RETRIES:
+                    logger.error("Error: BatchGetItem unprocessed keys limit")
+                    break
+                sleep(pow(2, retries) * 0.05)
+    return found, calls
+
+def _expire_at():
+    epoch = datetime.utcfromtimestamp(0)
+    epochexp = (datetime.now()+timedelta(days=15) - epoch).total_seconds() * 1000.0
+    return int(epochexp)
+
+@xray_recorder.capture('## ClaimDynamo')
+def ClaimImage(image):
+    """Record the image unless another invocation already did.
+
+    A single conditional put both checks and records the url, so only the
+    invocation that created the record processes the image.
+    """
     try:
-        response = dyn_table.query(
-        KeyConditionExpression=Key('img_url').eq(str(url))
+        dyn_table.put_item(
+            Item={
+                'img_url': str(image["image_url"]),
+                'tweet_id': image["tweet_id"],
+                'expire_at': _expire_at()
+            },
+            ConditionExpression='attribute_not_exists(img_url)'
         )
-        return response
+        return True
 
     except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
         logger.error(e.response['Error']['Message'])
-        return {'Items': [], 'Count': 0}
+        return True
+
+def ClaimImages(images):
+    """Claim the images concurrently and return the ones this invocation owns."""
+    owned = parallel(ClaimImage, images, CLAIM_CONCURRENCY)
+    return [image for image, ok in zip(images, owned) if ok]
+
+@xray_recorder.capture('## ProbeImage')
+def ProbeImage(image):
+    """Return False when the image header shows it can never produce a stored face record."""
+    info = probe(image["image_url"])
+    if info is None:
+        # unknown format or probe failure, let the analysis decide
+        return True
+    if info["width"] < MIN_IMAGE_WIDTH:
+        logger.info("Rejecting %s %s image %dx%d", image["image_url"], info["format"], info["width"], info["height"])
+        return False
+    return True
+
+def ProbeImages(images):
+    """Probe the images concurrently and return the ones worth analysing."""
+    accepted = parallel(ProbeImage, images, CLAIM_CONCURRENCY)
+    return [image for image, ok in zip(images, accepted) if ok]
 
-@xray_recorder.capture('## AddDynamo')            
-def AddImage(url,tweet_id):
+@xray_recorder.capture('## ReleaseDynamo')
+def ReleaseImage(image):
+    """Drop a claim so that a later invocation can process the image."""
     try:
-        epoch = datetime.utcfromtimestamp(0)
-        epochexp = (datetime.now()+timedelta(days=15) - epoch).total_seconds() * 1000.0
-        response = dyn_table.put_item(
-        Item={
-            'img_url': str(url),
-            'tweet_id': tweet_id,
-            'expire_at': int(epochexp)
-            }
+        dyn_table.delete_item(
+            Key={'img_url': str(image["image_url"])},
+            ConditionExpression=Attr('tweet_id').eq(image["tweet_id"])
         )
-        return response
-
     except ClientError as e:
         logger.error(e.response['Error']['Message'])
-    return {'Items': [], 'Count': 0}
+
+@xray_recorder.capture('## Calling Analyze')
+def CallAnalyze(images):
+    """Hand the images to the fused analysis function."""
+    lambda_client.invoke(
+        FunctionName=ANALYZE_FUNCTION_NAME,
+        InvocationType='Event',
+        Payload=json.dumps({'images': images})
+    )
 
 @xray_recorder.capture('## Calling StepFunction')
-def CallStepFunction(tweet):
-    client = boto3.client('stepfunctions') 
-    response = client.start_execution(
+def CallStepFunction(images):
+    """Start one execution that fans out over the given images."""
+    response = sfn.start_execution(
         stateMachineArn=STATE_MACHINE_ARN,
-        name=tweet["tweet_id"],
-        input=json.dumps(tweet)
+        name=images[0]["tweet_id"],
+        input=json.dumps({'images': images})
     )
-    AddImage(tweet["image_url"],tweet["tweet_id"])
     #logger.info(json.dumps(hdata))    
 
+def _remember(urls):
+    for url in urls:
+        seen_urls.put(url)
+        seen_bloom.add(url)
+
+def _photos(rec):
+    """Return the photos of a compact poller record or of a raw tweet."""
+    if "photos" in rec:
+        return rec["photos"]
+    media = rec.get("extended_entities", {}).get("media", [])
+    return [m for m in media if "media_url_https" in m and m["type"] == "photo"]
+
 @metric_scope
 def handler(event, context, metrics):
     skipped_count = 0
     processed_count = 0
     no_image = 0
-    for rec in event:        
-        if "extended_entities" in rec:            
-            if "media" in rec["extended_entities"]:
-                for m in rec["extended_entities"]["media"]:
-                    if "media_url_https" in m:
-                        if m["type"] == "photo":
-                            dyn_resp = GetImage(m["media_url_https"])
-                            if dyn_resp["Count"] == 0:
-                                processed_count += 1
-                                CallStepFunction({'tweet_id': m["id_str"], 'full_text': rec["full_text"], 'image_url': m["media_url_https"]})
-                            else:
-                                skipped_count += 1                            
-                        else:
-                            no_image += 1
-                    else:
-                        no_image += 1
-            else:
-                no_image += 1
-        else:
+    candidates = {}
+    photo_count = 0
+    lru_hits = 0
+    bloom_hits = 0
+    for rec in event:
+        photos = _photos(rec)
+        if not photos:
             no_image += 1
+            continue
+        for m in photos:
+            photo_count += 1
+            if m["media_url_https"] in candidates:
+                skipped_count += 1
+                continue
+            if seen_urls.get(m["media_url_https"]):
+                lru_hits += 1
+                skipped_count += 1
+                continue
+            if m["media_url_https"] in seen_bloom:
+                bloom_hits += 1
+                skipped_count += 1
+                continue
+            candidates[m["media_url_https"]] = {'tweet_id': m["id_str"], 'full_text': rec["full_text"], 'image_url': m["media_url_https"]}
+
+    # the batch read cheaply drops images recorded by other containers, the
+    # conditional puts then decide ownership of the rest
+    known, get_calls = GetImages(list(candidates))
+    fresh = [tweet for url, tweet in candidates.items() if url not in known]
+    claimed = ClaimImages(fresh)
+    skipped_count += len(candidates) - len(claimed)
+    # rejected images stay claimed so they are not probed again
+    accepted = ProbeImages(claimed)
+    rejected_count = len(claimed) - len(accepted)
+    started = []
+    try:
+        for i in range(0, len(accepted), SFN_BATCH_SIZE):
+            images = accepted[i:i + SFN_BATCH_SIZE]
+            if ANALYSIS_MODE == 'fused':
+                CallAnalyze(images)
+            else:
+                CallStepFunction(images)
+            started.extend(images)
+    except Exception:
+        for tweet in accepted[len(started):]:
+            ReleaseImage(tweet)
+        raise
+    finally:
+        released = set(tweet["image_url"] for tweet in accepted[len(started):])
+        _remember(url for url in candidates if url not in released)
+        if seen_bloom.dirty:
+            seen_bloom.save(SEEN_BLOOM_PATH)
 
+    # one query per photo plus one put per started image before batching
+    processed_count = len(started)
+    round_trips = get_calls + len(fresh)
+    round_trips_saved = photo_count + processed_count - round_trips
 
     metrics.set_namespace('TwitterRekognition')
     metrics.put_metric("TweetsProcessed", len(event), "Count")
     metrics.put_metric("ImagesIdentified", processed_count, "Count")
+    metrics.put_metric("ExecutionsStarted" if ANALYSIS_MODE != 'fused' else "AnalyzeInvokes", -(-processed_count // SFN_BATCH_SIZE), "Count")
+    metrics.put_metric("ImagesRejected", rejected_count, "Count")
+    metrics.put_metric("SeenCacheHits", lru_hits + bloom_hits, "Count")
+    metrics.put_metric("SeenCacheMisses", len(candidates), "Count")
     metrics.set_property("RequestId", context.aws_request_id)
     metrics.set_property(
-        "payload", { "tweets": str(len(event)) ,"processed": processed_count, "skipped": skipped_count, "no_image": no_image }
+        "payload", { "tweets": str(len(event)) ,"processed": processed_count, "skipped": skipped_count, "no_image": no_image, "rejected": rejected_count,
+                     "ddb_round_trips": round_trips, "ddb_round_trips_saved": round_trips_saved,
+                     "lru_hits": lru_hits, "bloom_hits": bloom_hits }
     )
 
-    return True
\ No newline at end of file
+    return True
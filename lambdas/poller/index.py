@@ -1,14 +1,22 @@
 import json
+import logging
 import os
 import sys
+import threading
+import time
 
 import boto3
 import twitter
 
+from aws_embedded_metrics import metric_scope
 from boto3.dynamodb.conditions import Attr, Or
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 
-LAMBDA = boto3.client('lambda')
+MAX_INFLIGHT_INVOKES = int(os.getenv('MAX_INFLIGHT_INVOKES', '4'))
+
+LAMBDA = boto3.client('lambda', config=Config(max_pool_connections=MAX_INFLIGHT_INVOKES))
 SSM = boto3.client('ssm')
 DDB = boto3.resource('dynamodb')
 TABLE = DDB.Table(os.getenv('SEARCH_CHECKPOINT_TABLE_NAME'))
@@ -17,6 +25,11 @@ RECORD_KEY = 'checkpoint'
 SEARCH_TEXT = os.getenv('SEARCH_TEXT')
 TWEET_PROCESSOR_FUNCTION_NAME = os.getenv('TWEET_PROCESSOR_FUNCTION_NAME')
 BATCH_SIZE = int(os.getenv('BATCH_SIZE'))
+BATCH_BYTES = int(os.getenv('BATCH_BYTES', '240000'))
+DEADLINE_RESERVE_MS = int(os.getenv('DEADLINE_RESERVE_MS', '10000'))
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
 
 SSM_PARAMETER_PREFIX = os.getenv("SSM_PARAMETER_PREFIX")
 CONSUMER_KEY_PARAM_NAME = '/{}/consumer_key'.format(SSM_PARAMETER_PREFIX)
@@ -24,53 +37,192 @@ CONSUMER_SECRET_PARAM_NAME = '/{}/consumer_secret'.format(SSM_PARAMETER_PREFIX)
 ACCESS_TOKEN_PARAM_NAME = '/{}/access_token'.format(SSM_PARAMETER_PREFIX)
 ACCESS_TOKEN_SECRET_PARAM_NAME = '/{}/access_token_secret'.format(SSM_PARAMETER_PREFIX)
 
-def handler(event, context):
-    """Forward SQS messages to Kinesis Firehose Delivery Stream."""
-    for batch in _search_batches():
+@metric_scope
+def handler(event, context, metrics):
+    """Forward tweets matching SEARCH_TEXT to the tweet processor function.
+
+    Search pages are fetched while the batches of the previous page are still
+    being sent, and the checkpoint only moves past a page once all of its
+    invokes have completed. Paging stops DEADLINE_RESERVE_MS before the
+    function times out and the next run resumes from the saved cursor.
+    """
+    dispatcher = Dispatcher(MAX_INFLIGHT_INVOKES)
+    pending = None
+    page_timings = []
+    scanned = 0
+    records = 0
+    try:
+        for checkpoint, batches, page_size, elapsed in _search_pages(context):
+            page_timings.append(elapsed)
+            scanned += page_size
+            records += sum(len(batch) for batch in batches)
+            futures = [dispatcher.submit(batch) for batch in batches]
+            if pending:
+                _checkpoint(*pending)
+            pending = (checkpoint, futures)
+        if pending:
+            _checkpoint(*pending)
+    finally:
+        dispatcher.shutdown()
+
+    resumable = pending is not None and pending[0][1] is not None
+
+    metrics.set_namespace('TwitterRekognition')
+    for elapsed in page_timings:
+        metrics.put_metric("SearchPageLatency", elapsed, "Milliseconds")
+    for elapsed in dispatcher.timings:
+        metrics.put_metric("InvokeLatency", elapsed, "Milliseconds")
+    metrics.put_metric("ParserInvokes", len(dispatcher.timings), "Count")
+    metrics.put_metric("TweetsScanned", scanned, "Count")
+    metrics.put_metric("TweetsWithPhotos", records, "Count")
+    metrics.set_property("RequestId", context.aws_request_id)
+    metrics.set_property(
+        "payload", { "pages": len(page_timings), "invokes": len(dispatcher.timings), "max_inflight": MAX_INFLIGHT_INVOKES, "resumable": resumable }
+    )
+
+
+class Dispatcher:
+    """Invoke the tweet processor from a bounded pool of worker threads."""
+
+    def __init__(self, max_inflight):
+        self._pool = ThreadPoolExecutor(max_workers=max_inflight)
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self.timings = []
+
+    def submit(self, batch):
+        """Queue an invoke, blocking while max_inflight invokes are running."""
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(self._invoke, batch)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+    def _invoke(self, batch):
+        start = time.perf_counter()
         LAMBDA.invoke(
             FunctionName=TWEET_PROCESSOR_FUNCTION_NAME,
             InvocationType='Event',
-            Payload=json.dumps(batch)
+            Payload='[' + ', '.join(batch) + ']'
         )
+        elapsed = (time.perf_counter() - start) * 1000
+        logger.info("Invoke: %d tweets in %.1f ms", len(batch), elapsed)
+        self.timings.append(elapsed)
 
-def _search_batches():
-    since_id = last_id()
 
-    tweets = []
-    while True:
-        result = search(SEARCH_TEXT, since_id)
-        if not result['statuses']:
-            # no more results
-            break
+def _checkpoint(checkpoint, futures):
+    """Wait for the invokes of a page and save the checkpoint that follows it."""
+    for future in futures:
+        future.result()
+    update(*checkpoint)
+
+
+def _search_pages(context):
+    """Yield ((since_id, cursor), batches, page_size, elapsed_ms) for each search page.
+
+    Tweets are read in windows. A window spans from the last checkpoint
+    (since_id) up to the newest tweet found when the window was opened
+    (top_id), and is walked backwards with max_id. The cursor holds top_id and
+    the max_id of the next page; it is cleared and since_id moves to top_id
+    once the window is exhausted.
+    """
+    since_id, cursor = last_checkpoint()
+
+    while context.get_remaining_time_in_millis() > DEADLINE_RESERVE_MS:
+        start = time.perf_counter()
+        if cursor is None:
+            result = search(SEARCH_TEXT, since_id)
+        else:
+            result = search(SEARCH_TEXT, since_id, cursor['max_id'])
+        elapsed = (time.perf_counter() - start) * 1000
 
         tweets = result['statuses']
-        size = len(tweets)
-        for i in range(0, size, BATCH_SIZE):
-            yield tweets[i:min(i + BATCH_SIZE, size)]
-        since_id = result['search_metadata']['max_id']
-        update(since_id)
-
-def last_id():
-    """Return last checkpoint tweet id."""
+        logger.info("Search page: %d tweets in %.1f ms", len(tweets), elapsed)
+        if not tweets:
+            if cursor is None:
+                # no more results
+                break
+            # window exhausted, the next one starts after its newest tweet
+            since_id, cursor = cursor['top_id'], None
+            yield (since_id, cursor), [], 0, elapsed
+            continue
+
+        ids = [int(tweet['id']) for tweet in tweets]
+        top_id = max(ids) if cursor is None else cursor['top_id']
+        cursor = {'top_id': top_id, 'max_id': min(ids) - 1}
+        if since_id is None:
+            # first run, do not walk back through the whole search history
+            since_id, cursor = cursor['top_id'], None
+
+        records = [record for record in map(_project, tweets) if record]
+        yield (since_id, cursor), _pack(records), len(tweets), elapsed
+    else:
+        logger.info("Stopping before deadline, checkpoint: since_id=%s cursor=%s", since_id, cursor)
+
+
+def _project(tweet):
+    """Return the compact record the parser needs, or None for tweets without photos."""
+    media = tweet.get('extended_entities', {}).get('media', [])
+    photos = [
+        {'id_str': m['id_str'], 'media_url_https': m['media_url_https']}
+        for m in media if m.get('type') == 'photo' and 'media_url_https' in m
+    ]
+    if not photos:
+        return None
+    return {'id_str': tweet['id_str'], 'full_text': tweet['full_text'], 'photos': photos}
+
+
+def _pack(records):
+    """Group JSON encoded records into batches of at most BATCH_BYTES and BATCH_SIZE records."""
+    batches = []
+    batch = []
+    size = 2
+    for record in records:
+        encoded = json.dumps(record)
+        if batch and (size + len(encoded) + 2 > BATCH_BYTES or len(batch) >= BATCH_SIZE):
+            batches.append(batch)
+            batch = []
+            size = 2
+        batch.append(encoded)
+        size += len(encoded) + 2
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def last_checkpoint():
+    """Return the last checkpoint tweet id and the cursor of an unfinished window."""
     result = TABLE.get_item(
         Key={'id': RECORD_KEY}
     )
-    if 'Item' in result:
-        return result['Item']['since_id']
-    return None
+    if 'Item' not in result:
+        return None, None
+    item = result['Item']
+    cursor = item.get('cursor')
+    if cursor:
+        cursor = {'top_id': int(cursor['top_id']), 'max_id': int(cursor['max_id'])}
+    return int(item['since_id']), cursor or None
 
 
-def update(since_id):
-    """Update checkpoint to given tweet id."""
+def update(since_id, cursor=None):
+    """Update checkpoint to given tweet id and window cursor."""
+    item = {
+        'id': RECORD_KEY,
+        'since_id': since_id
+    }
+    if cursor:
+        item['cursor'] = cursor
     try:
         TABLE.put_item(
-            Item={
-                'id': RECORD_KEY,
-                'since_id': since_id
-            },
+            Item=item,
             ConditionExpression=Or(
                 Attr('id').not_exists(),
-                Attr('since_id').lt(since_id)
+                Attr('since_id').lte(since_id)
             )
         )
     except ClientError as e:
@@ -78,9 +230,9 @@ def update(since_id):
             raise
 
 
-def search(search_text, since_id=None):
+def search(search_text, since_id=None, max_id=None):
     """Search for tweets matching the given search text."""
-    return TWITTER.GetSearch(term=search_text, count=100, return_json=True, since_id=since_id)
+    return TWITTER.GetSearch(term=search_text, count=100, return_json=True, since_id=since_id, max_id=max_id)
 
 
 def _create_twitter_api():
@@ -1,5 +1,6 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
+import gzip
 import json
 import urllib
 import boto3
@@ -7,11 +8,18 @@ import logging
 import base64
 import time
 import os
-import requests
 import random
 import uuid
 from datetime import datetime, timedelta
+from botocore.config import Config
 from aws_embedded_metrics import metric_scope
+import faceschema
+import langid
+from imagestore import ImageStore, download
+from throttle import RateLimiter, NO_RETRY_CONFIG
+from sentimentcache import SentimentCache
+from emotionindex import EmotionIndex
+from tracing import parallel
 from PIL import Image
 from io import BytesIO
 from aws_xray_sdk.core import xray_recorder
@@ -21,161 +29,350 @@ patch_all()
 
 BUCKET_NAME = os.getenv('BUCKET_NAME')
 FireHoseName = os.getenv('TwitterDeliveryStream')
+MIN_IMAGE_WIDTH = int(os.getenv('MIN_IMAGE_WIDTH', '500'))
+COMPREHEND_TPS = float(os.getenv('COMPREHEND_TPS', '20'))
+THROTTLE_TABLE = os.getenv('THROTTLE_TABLE') or None
+OUTPUT_MODE = os.getenv('OUTPUT_MODE', 'objects')
+OUTPUT_CHUNK_BYTES = int(os.getenv('OUTPUT_CHUNK_BYTES', str(16 * 1024 * 1024)))
+EMOTION_INDEX_TABLE = os.getenv('EMOTION_INDEX_TABLE')
+EMOTION_INDEX_SIZE = int(os.getenv('EMOTION_INDEX_SIZE', '100'))
+EMOTION_INDEX_MIN_CONFIDENCE = float(os.getenv('EMOTION_INDEX_MIN_CONFIDENCE', '50'))
+SENTIMENT_TABLE = os.getenv('SENTIMENT_TABLE')
+SENTIMENT_CACHE_SIZE = int(os.getenv('SENTIMENT_CACHE_SIZE', '10000'))
+SENTIMENT_CACHE_TTL = int(os.getenv('SENTIMENT_CACHE_TTL', str(7 * 86400)))
+
+LANGID_THRESHOLD = float(os.getenv('LANGID_THRESHOLD', '0.5'))
+
+COMPREHEND_BATCH_SIZE = 25
+S3_CONCURRENCY = 16
+# put_record_batch accepts up to 500 records and 4 MiB per call
+FIREHOSE_BATCH_RECORDS = 500
+FIREHOSE_BATCH_BYTES = 4 * 1024 * 1024
+FIREHOSE_RETRIES = 3
+# languages accepted by Comprehend sentiment detection
+SENTIMENT_LANGUAGES = {'ar', 'hi', 'ko', 'zh-TW', 'ja', 'zh', 'de', 'pt', 'en', 'it', 'fr', 'es'}
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3 = boto3.client('s3')
-comprehend = boto3.client('comprehend')
+s3 = boto3.client('s3', config=Config(max_pool_connections=S3_CONCURRENCY))
+comprehend = boto3.client('comprehend', config=NO_RETRY_CONFIG)
+language_limiter = RateLimiter('BatchDetectDominantLanguage', COMPREHEND_TPS, table_name=THROTTLE_TABLE)
+sentiment_limiter = RateLimiter('BatchDetectSentiment', COMPREHEND_TPS, table_name=THROTTLE_TABLE)
+sentiment_cache = SentimentCache(SENTIMENT_TABLE, maxsize=SENTIMENT_CACHE_SIZE, ttl=SENTIMENT_CACHE_TTL)
+emotion_index = EmotionIndex(EMOTION_INDEX_TABLE, size=EMOTION_INDEX_SIZE, min_confidence=EMOTION_INDEX_MIN_CONFIDENCE) if EMOTION_INDEX_TABLE else None
 firehose = boto3.client('firehose')
+images = ImageStore(BUCKET_NAME, s3=s3)
+staged_faces = ImageStore(BUCKET_NAME, prefix='cache/facerecords/', s3=s3)
 
 male_names = ["Michael","Patrick","Stefan","Daniel","Thomas","Christoph","Dominik","Lukas","Philip","Florian","Manuel","Andreas","Alexander","Markus","Martin","Matthias","Christian","Mario","Bernhard","Johannes","Maximilian","Benjamin","Raphael","Peter","Christopher","René","Simon","Marco","Fabian","Julian","Marcel","Georg","Jakob","Tobias","Clemens","Robert","Oliver","Paul","Jürgen","Wolfgang","Felix","Josef","Hannes","Roman","Gerald","Sascha","Franz","Klaus","Pascal","Roland","Richard","Gregor","Harald","Gerhard","Armin","Gabriel","Marc","Alex","Alexis","Antonio","Austin","Beau","Beckett","Bentley","Brayden","Bryce","Caden","Caleb","Camden","Cameron","Carter","Casey","Cash","Charles","Charlie","Chase","Clark","Cohen","Connor","Cooper","David","Dawson","Declan","Dominic","Drake","Drew","Dylan","Edward","Eli","Elijah","Elliot","Emerson","Emmett","Ethan","Evan","Ezra","Felix","Gage","Gavin","Gus","Harrison","Hayden","Henry","Hudson","Hunter","Isaac","Jace","Jack","Jackson","Jacob","James","Jase","Jayden","John","Jonah","Joseph","Kai","Kaiden","Kingston","Levi","Liam","Logan","Lucas","Luke","Marcus","Mason","Matthew","Morgan","Nate","Nathan","Noah","Nolan","Oliver","Owen","Parker","Raphaël","Riley","Ryan","Samuel","Sebastian","Seth","Simon","Tanner","Taylor","Theo","Tristan","Turner","Ty","William","Wyatt"]
 female_names = ["Julia","Lisa","Stefanie","Katharina","Melanie","Christina","Sabrina","Sarah","Anna","Sandra","Katrin","Carina","Bianca","Nicole","Jasmin","Kerstin","Tanja","Jennifer","Verena","Daniela","Theresa","Viktoria","Elisabeth","Nadine","Nina","Tamara","Madalena","Claudia","Jacquelina","Machaela","Martina","Denise","Barbara","Bettina","Alexandra","Cornelia","Maria","Vanessa","Andrea","Johanna","Eva","Natalie","Sabine","Isabella","Anja","Simone","Janine","Marlene","Patricia","Petra","Laura","Yvonne","Manuela","Karin","Birgit","Caroline","Tine","Carmen","Abigail","Adalyn","Aleah","Alexa","Alexis","Alice","Alyson","Amelia","Amy","Anabelle","Anna","Annie","Aria","Aubree","Ava","Ayla","Brielle","Brooke","Brooklyn","Callie","Camille","Casey","Charlie","Charlotte","Chloe","Claire","Danica","Elizabeth","Ella","Ellie","Elly","Emersyn","Emily","Emma","Evelyn","Felicity","Fiona","Florence","Georgia","Hailey","Haley","Isla","Jessica","Jordyn","Juliette","Kate","Katherine","Kayla","Keira","Kinsley","Kyleigh","Lauren","Layla","Lea","Leah","Lexi","Lily","Lydia","Lylah","Léa","Macie","Mackenzie","Madelyn","Madison","Maggie","Marley","Mary","Maya","Meredith","Mila","Molly","Mya","Olivia","Paige","Paisley","Peyton","Piper","Quinn","Rebekah","Rosalie","Ruby","Sadie","Samantha","Savannah","Scarlett","Selena","Serena","Sofia","Sophia","Sophie","Stella","Summer","Taylor","Tessa","Victoria","Violet","Zoey","Zoé"]
 surnames = ["Silva","Lopez","Rodrigues","Jones","Martinez","Hernandez","Abbot","Ross","Pitt","Foster","Gruber","Huber","Bauer","Wagner","Müller","Pichler","Steiner","Moser","Mayer","Hofer","Leitner","Berger","Fuchs","Eder","Fischer","Schmid","Winkler","Weber","Schwarz","Maier","Schneider","Reiter","Mayr","Schmidt","Wimmer","Egger","Brunner","Lang","Baumgartner","Auer","Binder","Lechner","Wolf","Novak","Wallner","Aigner","Ebner","Koller","Lehner","Haas","Schuster","Anderson","Bergeron","Bouchard","Boucher","Butler","Santiago","Cruz","Brown","Bélanger","Campbell","Chan","Clark","Cote","Fortin","Gagnon","Gagné","Gauthier","Chu","Yong","Girard","Johnson","Jones","Lam","Lavoie","Lavoie","Leblanc","Lee","Li","Lévesque","Martin","Morin","Ortega","Ouellet","Paquette","Patel","Pelletier","Roy","Simard","Smith","Taylor","Thompson","Tremblay","White","Williams","Wilson","Wong"]
 
-def GetDominantLanguage(tweet_text):
-    language = "en"
-    score = 0
-    try:                
-        if len(tweet_text) > 25:
-            response = comprehend.detect_dominant_language(
-                Text=tweet_text
+def GetImageSize(event_data):
+    """Return the image size passed by the Rekognition step, reading the stored image for older payloads."""
+    if "imgWidth" in event_data:
+        return event_data["imgWidth"], event_data["imgHeight"]
+    if "image_key" in event_data:
+        content = images.get(event_data["image_key"])
+    else:
+        content = download(event_data["image_url"])
+    with Image.open(BytesIO(content)) as image:
+        return image.size
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+@xray_recorder.capture('## Batch Detect Dominant Language')
+def GetDominantLanguages(texts):
+    """Return the dominant language of each text, batching the texts the local identifier is unsure of."""
+    languages = ["en"] * len(texts)
+    calls = 0
+    pending = []
+    for i, text in enumerate(texts):
+        if len(text) <= 25:
+            continue
+        language, confidence = langid.identify(text)
+        if confidence >= LANGID_THRESHOLD:
+            languages[i] = language
+        else:
+            pending.append(i)
+    local = len(texts) - len(pending)
+    for chunk in _chunks(pending, COMPREHEND_BATCH_SIZE):
+        try:
+            response = language_limiter.call(
+                comprehend.batch_detect_dominant_language,
+                TextList=[texts[i] for i in chunk]
             )
-            for l in response["Languages"]:
-                lcode = l["LanguageCode"]
-                lscore = l["Score"]
-                if lscore > score:
-                    score = lscore
-                    language = lcode
-            
-            return language
+            calls = calls + 1
+        except Exception as e:
+            logger.error('Something went wrong: ' + str(e))
+            continue
+
+        for result in response["ResultList"]:
+            if result["Languages"]:
+                best = max(result["Languages"], key=lambda l: l["Score"])
+                languages[chunk[result["Index"]]] = best["LanguageCode"]
+        for error in response["ErrorList"]:
+            logger.error('Language detection failed: ' + error["ErrorMessage"])
+
+    return languages, calls, local
+
+@xray_recorder.capture('## Batch Detect Sentiment')
+def GetSentiments(texts, languages):
+    """Return the sentiment of each text, one batch call per language and 25 texts."""
+    sentiments = ['Unknow'] * len(texts)
+    calls = 0
+    by_language = {}
+    for i, language in enumerate(languages):
+        if language in SENTIMENT_LANGUAGES:
+            by_language.setdefault(language, []).append(i)
+
+    for language, indexes in by_language.items():
+        for chunk in _chunks(indexes, COMPREHEND_BATCH_SIZE):
+            try:
+                response = sentiment_limiter.call(
+                    comprehend.batch_detect_sentiment,
+                    TextList=[texts[i] for i in chunk],
+                    LanguageCode=language
+                )
+                calls = calls + 1
+            except Exception as e:
+                logger.error('Something went wrong: ' + str(e))
+                continue
+
+            for result in response["ResultList"]:
+                sentiments[chunk[result["Index"]]] = result["Sentiment"]
+            for error in response["ErrorList"]:
+                logger.error('Sentiment detection failed: ' + error["ErrorMessage"])
+
+    return sentiments, calls
 
+def ProcessImage(event_data, sentiment, counts):
+    """Return one record per identified face of an analysed image."""
+    records = []
+    identified_faces = event_data["facerecords"]
+
+    imgWidth, imgHeight = GetImageSize(event_data)
+
+    for face in identified_faces:                     
+        if (int(face["Confidence"])) < 80:
+            counts["face_not_identified_count"] = counts["face_not_identified_count"] + 1
+            continue
+
+        fdata = {}
+        face_id = str(uuid.uuid4())
+        logger.info('## FaceId: ' + face_id)
+        
+        if str(face["Gender"]["Value"]).lower() == "male":
+            fdata["first_name"] = random.choice(male_names)
         else:
-            return language
+            fdata["first_name"] = random.choice(female_names)
+        
+        fdata["sentiment"] = sentiment
+            
+        fdata["last_name"] = random.choice(surnames)
+        
+        fdata["image_url"] = event_data["image_url"]
+        fdata["full_text"] = event_data["full_text"]
+        fdata["tweet_id"] = event_data["tweet_id"]
+        fdata["gender"] = face["Gender"]
+        fdata["face_id"] = face_id
+        fdata["emotions"] = face["Emotions"]            
+        fdata.update(faceschema.flatten_emotions(face["Emotions"]))
+        fdata["agerange"] = face["AgeRange"]
 
-    except Exception as e:
-        logger.error('Something went wrong: ' + str(e))
-        return language
+        # calculate the bounding boxes the detected face 
+        box = face["BoundingBox"]
+        left = imgWidth * box['Left']
+        top = imgHeight * box['Top']
+        width = imgWidth * box['Width']
+        height = imgHeight * box['Height']
 
-def GetSentiment(tweet_text, language_code):
-    try:
-        response = comprehend.detect_sentiment(
-            Text=tweet_text,
-            LanguageCode=language_code
-        )
+        fdata["bbox_left"] = left
+        fdata["bbox_top"] = top
+        fdata["bbox_width"] = width
+        fdata["bbox_height"] = height 
+        fdata["imgWidth"] = imgWidth 
+        fdata["imgHeight"] = imgHeight
+        fdata["updated_at"] = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+
+        counts["processed"] = counts["processed"] + 1
 
-        return response["Sentiment"]
+        if imgWidth < MIN_IMAGE_WIDTH:
+            counts["low_res"] = counts["low_res"] + 1
+            continue
 
+        logger.info(fdata)
+        records.append(fdata)
+
+    return records
+
+def PutObject(fdata):
+    s3.put_object(
+        ACL='private',
+        Body=json.dumps(fdata),
+        Bucket=BUCKET_NAME,          
+        Key="data/json-records/" + fdata["face_id"] + '.json'
+    )        
+
+def _ndjson_chunks(records):
+    """Yield newline delimited json bodies of at most OUTPUT_CHUNK_BYTES each."""
+    lines = []
+    size = 0
+    for fdata in records:
+        line = json.dumps(fdata).encode('utf-8') + b'\n'
+        if lines and size + len(line) > OUTPUT_CHUNK_BYTES:
+            yield b''.join(lines)
+            lines = []
+            size = 0
+        lines.append(line)
+        size += len(line)
+    if lines:
+        yield b''.join(lines)
+
+def PutChunk(body):
+    key = "data/json-records/" + datetime.utcnow().strftime("%Y%m%dT%H%M%S") + '-' + str(uuid.uuid4())
+    if OUTPUT_MODE == 'ndjson-gzip':
+        body = gzip.compress(body)
+        key = key + '.json.gz'
+    else:
+        key = key + '.json'
+    s3.put_object(
+        ACL='private',
+        Body=body,
+        Bucket=BUCKET_NAME,
+        Key=key
+    )
+
+@xray_recorder.capture('## Write S3 Records')
+def PutObjects(records):
+    """Write the json records to S3, one object per face or newline delimited chunks."""
+    if OUTPUT_MODE == 'objects':
+        parallel(PutObject, records, S3_CONCURRENCY)
+        return len(records)
+    chunks = list(_ndjson_chunks(records))
+    parallel(PutChunk, chunks, S3_CONCURRENCY)
+    return len(chunks)
+
+def _firehose_batches(payloads):
+    batch = []
+    size = 0
+    for payload in payloads:
+        if batch and (len(batch) == FIREHOSE_BATCH_RECORDS or size + len(payload) > FIREHOSE_BATCH_BYTES):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(payload)
+        size += len(payload)
+    if batch:
+        yield batch
+
+@xray_recorder.capture('## Deliver Firehose Records')
+def PutRecords(records):
+    """Send the records with put_record_batch, retrying the ones Firehose failed.
+
+    Returns the number of records that could not be delivered.
+    """
+    undelivered = 0
+    for batch in _firehose_batches([json.dumps(fdata).encode('utf-8') for fdata in records]):
+        for attempt in range(FIREHOSE_RETRIES + 1):
+            if attempt:
+                time.sleep(min(1.0, 0.05 * 2 ** attempt) * random.random())
+            response = firehose.put_record_batch(
+                DeliveryStreamName=FireHoseName,
+                Records=[{'Data': payload} for payload in batch]
+            )
+            if not response["FailedPutCount"]:
+                batch = []
+                break
+            batch = [payload for payload, result in zip(batch, response["RequestResponses"]) if "ErrorCode" in result]
+            error = next((result for result in response["RequestResponses"] if "ErrorCode" in result), {})
+            logger.warning('Firehose rejected %d records: %s %s', len(batch), error.get("ErrorCode", ''), error.get("ErrorMessage", ''))
+        undelivered += len(batch)
+    return undelivered
+
+@xray_recorder.capture('## Update Emotion Index')
+def IndexEmotions(records):
+    """Keep the top faces of each emotion for getImage, the records stay the source of truth."""
+    if emotion_index is None or not records:
+        return 0
+    try:
+        return emotion_index.add(records)
     except Exception as e:
-        logger.error('Something went wrong: ' + str(e))        
-        return 'Unknow'
-    
+        logger.error('Emotion index update failed: ' + str(e))
+        return 0
+
 @metric_scope
 def handler(event, context, metrics):
+    """Process one Rekognition result or the list of results of a whole execution."""
     try:
-        if "result" in event:
-            if event["result"] == "Moderated":
-                logger.warning(event["msg"])
-                return {'result': 'Moderated' }      
-
-        faces_count = 0
-        low_res_count = 0
-        face_not_identified_count = 0
-        faces = []
-        fdata = {}
-        event_data = json.loads(event["data"])        
-        identified_faces = event_data["facerecords"]
-        fdata["first_name"] = 'NULL'
-        fdata["last_name"] = 'NULL'
-        logger.info('## Sentiment Analysis for ' + event_data["tweet_id"])
-        xray_recorder.begin_subsegment('## Comprehend Calls')
-        language = GetDominantLanguage(event_data["full_text"])        
-        sentiment = GetSentiment(event_data["full_text"],language)
-        xray_recorder.end_subsegment()
-
-        for face in identified_faces:                     
-            if (int(face["Confidence"])) < 80:
-                face_not_identified_count = face_not_identified_count + 1
-                continue
+        results = event if isinstance(event, list) else [event]
+        analysed = []
+        moderated_count = 0
+        for result in results:
+            if result.get("result") == "Moderated":
+                logger.warning(result.get("msg", "Image moderated"))
+                moderated_count = moderated_count + 1
+            elif result.get("result") == "Succeed":
+                analysed.append(faceschema.load(result["data"], fetch=staged_faces.get))
 
-            face_id = str(uuid.uuid4())
-            logger.info('## FaceId: ' + face_id)
-            xray_recorder.begin_subsegment('## FaceId: ' + face_id)
-            
-            if str(face["Gender"]["Value"]).lower() == "male":
-                fdata["first_name"] = random.choice(male_names)
-            else:
-                fdata["first_name"] = random.choice(female_names)
-            
-            fdata["sentiment"] = sentiment
-                
-            fdata["last_name"] = random.choice(surnames)
-            
-            fdata["image_url"] = event_data["image_url"]
-            fdata["full_text"] = event_data["full_text"]
-            fdata["tweet_id"] = event_data["tweet_id"]
-            fdata["gender"] = face["Gender"]
-            fdata["face_id"] = face_id
-            fdata["emotions"] = face["Emotions"]            
-            fdata["agerange"] = face["AgeRange"]
-
-            # calculate the bounding boxes the detected face 
-            r = requests.get(event_data["image_url"], allow_redirects=True)
-            stream = BytesIO(r.content)
-            image = Image.open(stream)
-            imgWidth, imgHeight = image.size 
-            box = face["BoundingBox"]
-            left = imgWidth * box['Left']
-            top = imgHeight * box['Top']
-            width = imgWidth * box['Width']
-            height = imgHeight * box['Height']
-
-            fdata["bbox_left"] = left
-            fdata["bbox_top"] = top
-            fdata["bbox_width"] = width
-            fdata["bbox_height"] = height 
-            fdata["imgWidth"] = imgWidth 
-            fdata["imgHeight"] = imgHeight
-            fdata["updated_at"] = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
-
-            faces_count = faces_count + 1
-            faces.append(face_id)
-
-            if imgWidth < 500:
-                low_res_count = low_res_count + 1
-                # logger.warning("Image width not greater than 500px. Not processing.")
-                continue
+        if not analysed:
+            return {'result': 'Moderated' if moderated_count else 'Succeed', 'count': '0'}
 
-            if len(event_data) > 2:
-                file_name = face_id + '.json'
-                key = "data/json-records/" + file_name  
-                logger.info(fdata)
-                s3.put_object(
-                    ACL='private',
-                    Body=json.dumps(fdata),
-                    Bucket=BUCKET_NAME,          
-                    Key=key
-                )        
-  
-                response = firehose.put_record(
-                    DeliveryStreamName=FireHoseName,
-                    Record={
-                        'Data': json.dumps(fdata)
-                    }
-                )  
-                        
-                xray_recorder.end_subsegment()
-        
-        if (len(identified_faces) > 0):
-            metrics.set_namespace('TwitterRekognition')
-            metrics.put_metric("FacesProcessed", faces_count, "Count")
-            metrics.set_property("RequestId", context.aws_request_id)            
-            metrics.set_property(
-                "payload", { "processed": faces_count, "low_res": low_res_count, "face_not_identified_count": face_not_identified_count }
-            )
+        # images of the same tweet share their text, it is analysed once
+        texts = list(dict.fromkeys(event_data["full_text"] for event_data in analysed))
+        analysis = sentiment_cache.get_many(texts)
+        pending = [text for text in texts if text not in analysis]
+        logger.info('## Sentiment Analysis for %d of %d texts of %d images', len(pending), len(texts), len(analysed))
+        languages, language_calls, local_languages = GetDominantLanguages(pending)
+        sentiments, sentiment_calls = GetSentiments(pending, languages)
+        detected = dict(zip(pending, zip(languages, sentiments)))
+        # failed detections are retried on the next occurrence of the text
+        sentiment_cache.put_many({text: value for text, value in detected.items() if value[1] != 'Unknow'})
+        analysis.update(detected)
+        sentiment_of = {text: sentiment for text, (language, sentiment) in analysis.items()}
+
+        counts = {"processed": 0, "low_res": 0, "face_not_identified_count": 0, "failed": 0}
+        records = []
+        for event_data in analysed:
+            try:
+                records.extend(ProcessImage(event_data, sentiment_of[event_data["full_text"]], counts))
+            except Exception as e:
+                logger.error('Processing ' + event_data["tweet_id"] + ' failed: ' + str(e))
+                counts["failed"] = counts["failed"] + 1
+
+        objects_written = PutObjects(records)
+        undelivered = PutRecords(records)
+        indexed = IndexEmotions(records)
 
-        return { 'result': 'Succeed', 'count': str(faces_count) }
+        comprehend_calls = language_calls + sentiment_calls
+        metrics.set_namespace('TwitterRekognition')
+        metrics.put_metric("FacesProcessed", counts["processed"], "Count")
+        metrics.put_metric("ComprehendCalls", comprehend_calls, "Count")
+        metrics.put_metric("ComprehendCallsSaved", 2 * len(analysed) - comprehend_calls, "Count")
+        metrics.put_metric("LanguagesIdentifiedLocally", local_languages, "Count")
+        metrics.put_metric("FirehoseUndelivered", undelivered, "Count")
+        metrics.put_metric("RecordObjectsWritten", objects_written, "Count")
+        metrics.put_metric("EmotionIndexWrites", indexed, "Count")
+        metrics.set_property("RequestId", context.aws_request_id)            
+        metrics.set_property(
+            "payload", dict(counts, images=len(analysed), texts=len(texts), cached_texts=len(texts) - len(pending), moderated=moderated_count, local_languages=local_languages, comprehend_calls=comprehend_calls, undelivered=undelivered)
+        )
+
+        if undelivered:
+            return {'result': 'Fail', 'msg': '%d face records could not be delivered to Firehose' % undelivered}
+        if counts["failed"] == len(analysed):
+            return {'result': 'Fail', 'msg': 'No image could be processed'}
+        return { 'result': 'Succeed', 'count': str(counts["processed"]) }
 
     except Exception as e:
         logger.error(str(e))
-        return {'result': 'Fail', 'msg': str(e) }
\ No newline at end of file
+        return {'result': 'Fail', 'msg': str(e) }
+
+    finally:
+        metrics.set_namespace('TwitterRekognition')
+        language_limiter.publish(metrics)
+        sentiment_limiter.publish(metrics)
+        sentiment_cache.publish(metrics)
\ No newline at end of file
@@ -9,15 +9,34 @@ import uuid
 import urllib 
 import io
 import os
-import requests
-from time import sleep
+import time
+from concurrent.futures import ThreadPoolExecutor
 from aws_embedded_metrics import metric_scope
+import faceschema
+from imagestore import ImageStore, download
+from phash import PhashIndex, dhash
+from throttle import RateLimiter, NO_RETRY_CONFIG
+from tracing import traced
+from PIL import Image, ImageOps
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 
 patch_all()
 
-S3Bucket = os.getenv('Bucket')
+S3Bucket = os.getenv('BUCKET_NAME')
+MIN_IMAGE_WIDTH = int(os.getenv('MIN_IMAGE_WIDTH', '500'))
+MAX_IMAGE_EDGE = int(os.getenv('MAX_IMAGE_EDGE', '1920'))
+JPEG_QUALITY = int(os.getenv('JPEG_QUALITY', '85'))
+DETECTION_MODE = os.getenv('DETECTION_MODE', 'sequential')
+REKOGNITION_TPS = float(os.getenv('REKOGNITION_TPS', '25'))
+THROTTLE_TABLE = os.getenv('THROTTLE_TABLE') or None
+PHASH_TABLE = os.getenv('PHASH_TABLE')
+PHASH_MAX_DISTANCE = int(os.getenv('PHASH_MAX_DISTANCE', '3'))
+# larger face records are stored in S3, the results of all images of an
+# execution must fit the 256 KB state payload of ProcessFaces
+INLINE_FACES_BYTES = int(os.getenv('INLINE_FACES_BYTES', '2048'))
+# Rekognition limit for images passed as bytes
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -25,86 +44,217 @@ logger.setLevel(logging.INFO)
 s3 = boto3.client('s3')
 s3_bucket = S3Bucket
 
-rek = boto3.client('rekognition')
+rek = boto3.client('rekognition', config=NO_RETRY_CONFIG)
+moderation_limiter = RateLimiter('DetectModerationLabels', REKOGNITION_TPS, table_name=THROTTLE_TABLE)
+faces_limiter = RateLimiter('DetectFaces', REKOGNITION_TPS, table_name=THROTTLE_TABLE)
+images = ImageStore(s3_bucket, s3=s3)
+staged_faces = ImageStore(s3_bucket, prefix='cache/facerecords/', s3=s3)
+phash_index = PhashIndex(PHASH_TABLE, s3_bucket, max_distance=PHASH_MAX_DISTANCE, s3=s3) if PHASH_TABLE else None
 
 status = ["success", "error", "moderated"]
 year_week = datetime.now().strftime("%Y-W%U")
 year_month = datetime.now().strftime("%Y-%m")
-    
-@metric_scope
-def handler(event, context, metrics):   
-        
-    r = requests.get(event["image_url"], allow_redirects=True)
 
-    attributes=[]
-    attributes.append("DEFAULT")
-    attributes.append("ALL")
+@xray_recorder.capture('## PrepareImage')
+def PrepareImage(content):
+    """Return the bytes to send to Rekognition and the size of the original image.
+
+    The image is rotated upright according to its EXIF orientation, downscaled
+    so that its longest edge is at most MAX_IMAGE_EDGE and re-encoded as JPEG
+    at JPEG_QUALITY. Small upright JPEG and PNG images are sent unchanged.
+
+    Rekognition bounding boxes are ratios of the analysed image and the
+    downscale is uniform, so the ratios times the returned original size give
+    original pixel coordinates, which is what ProcessFaces computes.
+    """
+    with Image.open(io.BytesIO(content)) as image:
+        orientation = image.getexif().get(0x0112, 1)
+        width, height = image.size
+        if orientation in (5, 6, 7, 8):
+            width, height = height, width
+        scale = min(1.0, MAX_IMAGE_EDGE / max(width, height))
+        if scale == 1.0 and orientation == 1 and image.format in ('JPEG', 'PNG') and len(content) <= MAX_IMAGE_BYTES:
+            return content, width, height, scale
+
+        upright = ImageOps.exif_transpose(image)
+        if scale < 1.0:
+            upright = upright.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+        if upright.mode not in ('RGB', 'L'):
+            upright = upright.convert('RGB')
+        out = io.BytesIO()
+        upright.save(out, format='JPEG', quality=JPEG_QUALITY)
+        return out.getvalue(), width, height, scale
+
+def _limited(label, limiter, call, **kwargs):
+    xray_recorder.begin_subsegment('## ' + label)
+    try:
+        return limiter.call(call, **kwargs)
+    finally:
+        xray_recorder.end_subsegment()
+
+def DetectModeration(payload):
+    return _limited('Moderation', moderation_limiter, rek.detect_moderation_labels, Image={'Bytes': payload}, MinConfidence=50)
+
+def DetectFaces(payload):
+    return _limited('DetectFaces', faces_limiter, rek.detect_faces, Image={"Bytes": payload}, Attributes=["DEFAULT", "ALL"])
 
-    retries = 0
-    while (retries < 5):
+def Detect(payload):
+    """Return the moderation and face detection responses of an image.
+
+    The face response is None when the image is moderated. In speculative mode
+    both calls are issued at once and the faces of a moderated image are
+    thrown away, trading a wasted DetectFaces call for lower latency.
+    """
+    if DETECTION_MODE != 'speculative':
+        mod_response = DetectModeration(payload)
+        if mod_response["ModerationLabels"]:
+            return mod_response, None
+        return mod_response, DetectFaces(payload)
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        faces = pool.submit(traced(DetectFaces), payload)
+        moderation = pool.submit(traced(DetectModeration), payload)
+        mod_response = moderation.result()
+        if mod_response["ModerationLabels"]:
+            return mod_response, None
+        return mod_response, faces.result()
+
+def _lookup_phash(payload):
+    """Return the hash of the image and the cached result of a near duplicate, if any."""
+    try:
+        with Image.open(io.BytesIO(payload)) as image:
+            h = dhash(image)
+        xray_recorder.begin_subsegment('## PhashLookup')
         try:
-            xray_recorder.begin_subsegment('## Moderation')
-            mod_response = rek.detect_moderation_labels(
-                Image={
-                    'Bytes': r.content
-                },
-                MinConfidence=50
-            )
+            cached = phash_index.lookup(h)
+        finally:
             xray_recorder.end_subsegment()
-            break
-
-        except Exception as e:
-            logger.error(str(e))                 
-            retries = retries + 1
-            logger.info("sleeps: " + str(pow(2, retries) * 0.15))
-            sleep(pow(2, retries) * 0.15)            
-            if retries == 5:
-                logger.error("Error: Moderation backoff limit")
-                return {'result': 'Fail', 'msg': str(e) + " Moderation backoff limit"} 
-            else:
-                continue
+        return h, cached
+    except Exception as e:
+        logger.error("Perceptual hash lookup failed: " + str(e))
+        return None, None
+
+def _index_phash(h, result):
+    if h is None:
+        return
+    try:
+        phash_index.add(h, result)
+    except Exception as e:
+        logger.error("Perceptual hash indexing failed: " + str(e))
+
+def _succeed(event, facerecords, image_key, imgWidth, imgHeight, scale):
+    hdata = {}
+    hdata['image_url'] = str(event["image_url"])
+    hdata['full_text'] = event['full_text']
+    hdata['schema'] = faceschema.SCHEMA_VERSION
+    facerecords = faceschema.project_faces(facerecords)
+    body = json.dumps(facerecords).encode('utf-8')
+    if len(body) > INLINE_FACES_BYTES:
+        hdata['facerecords_key'] = staged_faces.put(body)
+    else:
+        hdata['facerecords'] = facerecords
+    hdata['tweet_id'] = event["tweet_id"]
+    hdata['image_key'] = image_key
+    hdata['imgWidth'] = imgWidth
+    hdata['imgHeight'] = imgHeight
+    hdata['scale'] = scale
+
+    faces_count = len(facerecords)
+    return {'result': 'Succeed', 'count': str(faces_count), 'data': hdata}
+
+def publish_limits(metrics):
+    metrics.set_namespace('TwitterRekognition')
+    moderation_limiter.publish(metrics)
+    faces_limiter.publish(metrics)
+
+@metric_scope
+def handler(event, context, metrics):
+    try:
+        return _analyse(event, context, metrics)
+    finally:
+        publish_limits(metrics)
+
+@metric_scope
+def analyse(event, context, metrics):
+    """Rekognition step of one image of a batch, the caller publishes the rate limiter metrics once."""
+    return _analyse(event, context, metrics)
+
+def _analyse(event, context, metrics):
+    # downloaded once here, later stages read the stored copy or its size
+    try:
+        content = download(event["image_url"])
+        start = time.perf_counter()
+        payload, imgWidth, imgHeight, scale = PrepareImage(content)
+        prepare_ms = (time.perf_counter() - start) * 1000
+    except Exception as e:
+        logger.error(str(e))
+        return {'result': 'Fail', 'msg': str(e)}
+
+    metrics.set_namespace('TwitterRekognition')
+    metrics.put_metric("PreprocessLatency", prepare_ms, "Milliseconds")
+    metrics.put_metric("OriginalImageBytes", len(content), "Bytes")
+    metrics.put_metric("RekognitionPayloadBytes", len(payload), "Bytes")
+
+    # ProcessFaces never stores faces of narrow images, skip the paid calls
+    # and the stored copy
+    if imgWidth < MIN_IMAGE_WIDTH:
+        logger.warning("Image width %d below %d px. Not processing.", imgWidth, MIN_IMAGE_WIDTH)
+        metrics.put_metric("ImagesRejected", 1, "Count")
+        metrics.set_property("RequestId", context.aws_request_id)
+        return {'result': 'Fail', 'msg': 'Low resolution image'}
+
+    try:
+        xray_recorder.begin_subsegment('## StoreImage')
+        image_key = images.put(content)
+        xray_recorder.end_subsegment()
+    except Exception as e:
+        logger.error(str(e))
+        return {'result': 'Fail', 'msg': str(e)}
+
+    # a near duplicate of an analysed image reuses its moderation and faces
+    h = None
+    if phash_index:
+        h, cached = _lookup_phash(payload)
+        if cached:
+            distance, result = cached
+            logger.info("Near duplicate at distance %d: %s", distance, result['result'])
+            metrics.put_metric("PhashHits", 1, "Count")
+            if result['result'] == 'Moderated':
+                metrics.put_metric("ImagesModerated", 1, "Count")
+                metrics.set_property("RequestId", context.aws_request_id)
+                return {'result': 'Moderated' }
+            if result['result'] == 'Succeed':
+                return _succeed(event, result['facerecords'], image_key, imgWidth, imgHeight, scale)
+            return {'result': 'Fail', 'msg': result['msg']}
+        metrics.put_metric("PhashMisses", 1, "Count")
+
+    start = time.perf_counter()
+    try:
+        mod_response, rek_response = Detect(payload)
+    except Exception as e:
+        logger.error(str(e))
+        return {'result': 'Fail', 'msg': str(e)}
+    metrics.put_metric(DETECTION_MODE.capitalize() + "AnalysisLatency", (time.perf_counter() - start) * 1000, "Milliseconds")
+    if DETECTION_MODE == 'speculative':
+        # averaged over images this is the share of DetectFaces calls paid for nothing
+        metrics.put_metric("SpeculativeExtraCost", 0 if rek_response else 1, "None")
 
     if len(mod_response["ModerationLabels"]) != 0:
         metrics.set_namespace('TwitterRekognition')
         metrics.put_metric("ImagesModerated", 1, "Count")
         metrics.set_property("RequestId", context.aws_request_id)        
         metrics.set_property("Labels", mod_response["ModerationLabels"])
+        _index_phash(h, {'result': 'Moderated'})
         return {'result': 'Moderated' }
 
-    retries = 0
-    while (retries < 5):
-        try:
-            xray_recorder.begin_subsegment('## DetectFaces')            
-            rek_response = rek.detect_faces(
-                Image={"Bytes": r.content},
-                Attributes=attributes
-            )
-            xray_recorder.end_subsegment()
-            break
-
-        except Exception as e:
-            logger.error(str(e))                 
-            retries = retries + 1
-            logger.info("sleeps: " + str(pow(2, retries) * 0.15))
-            sleep(pow(2, retries) * 0.15)
-            if retries == 5:
-                logger.error("Error: FaceDetect backoff limit")
-                return {'result': 'Fail', 'msg': str(e) + " FaceDetect backoff limit"} 
-            else:
-                continue
-
     logger.info("FaceDetails: " + str(len(rek_response["FaceDetails"])))
 
     if len(rek_response["FaceDetails"]) > 0:
-        hdata = {}
-        hdata['image_url'] = str(event["image_url"])
-        hdata['full_text'] = event['full_text']
-        hdata['facerecords'] = rek_response["FaceDetails"]
-        hdata['tweet_id'] = event["tweet_id"]
-
-        faces_count = len(rek_response["FaceDetails"])
-        return {'result': 'Succeed', 'count': str(faces_count), 'data': json.dumps(hdata)}
+        facerecords = faceschema.project_faces(rek_response["FaceDetails"])
+        _index_phash(h, {'result': 'Succeed', 'facerecords': facerecords})
+        return _succeed(event, facerecords, image_key, imgWidth, imgHeight, scale)
         
     else:
         logger.error('Unable to rekognize any face')
+        _index_phash(h, {'result': 'Fail', 'msg': 'Unable to rekognize face'})
         return {'result': 'Fail', 'msg': 'Unable to rekognize face'}
\ No newline at end of file
@@ -0,0 +1,114 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import hashlib
+import logging
+import math
+import os
+import struct
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+class LRUCache:
+    """Bounded mapping that evicts the least recently used key."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value=True):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+class BloomFilter:
+    """Bloom filter sized for a capacity and false positive rate.
+
+    The filter is reset once it holds more than capacity keys or is older
+    than max_age seconds, so its false positive rate stays bounded.
+    """
+
+    _HEADER = struct.Struct('!QIdQ')
+
+    def __init__(self, capacity, error_rate, max_age=None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.max_age = max_age
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.created = time.time()
+        self.dirty = True
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = struct.unpack('!QQ', digest)
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        if all(self._bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key)):
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, key):
+        if self.count >= self.capacity or (self.max_age and time.time() - self.created > self.max_age):
+            logger.info("Bloom filter reset after %d keys", self.count)
+            self.clear()
+        for p in self._positions(key):
+            self._bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+        self.dirty = True
+
+    def save(self, path):
+        """Write the filter to path, replacing any previous copy atomically."""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self._HEADER.pack(self.size, self.hashes, self.created, self.count))
+            f.write(self._bits)
+        os.replace(tmp_path, path)
+        self.dirty = False
+
+    def load(self, path):
+        """Restore the filter from path if a compatible copy exists there."""
+        try:
+            with open(path, 'rb') as f:
+                size, hashes, created, count = self._HEADER.unpack(f.read(self._HEADER.size))
+                bits = f.read()
+        except (OSError, struct.error) as e:
+            logger.info("No saved bloom filter at %s: %s", path, e)
+            return False
+        if size != self.size or hashes != self.hashes or len(bits) != len(self._bits):
+            logger.info("Ignoring saved bloom filter with a different size")
+            return False
+        self._bits = bytearray(bits)
+        self.created = created
+        self.count = count
+        self.dirty = False
+        return True
@@ -0,0 +1,128 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import logging
+import random
+import time
+
+import boto3
+from boto3.dynamodb.conditions import Key
+
+logger = logging.getLogger()
+
+
+def _rank_key(confidence, face_id):
+    # sorts by confidence as a string, unique per face
+    return '%08.4f#%s' % (confidence, face_id)
+
+
+def face_item(fdata, emotion):
+    """Row of a face for one emotion, shaped like the Athena query of getImage returns it."""
+    return {
+        'face_id': fdata['face_id'],
+        'image_url': fdata['image_url'],
+        'first_name': fdata['first_name'],
+        'last_name': fdata['last_name'],
+        'age': str((fdata['agerange']['Low'] + fdata['agerange']['High']) // 2),
+        'gender_value': fdata['gender']['Value'],
+        'etype': emotion['Type'],
+        'confidence': str(round(emotion['Confidence'], 3)),
+        'full_text': fdata['full_text'],
+        'bbox_left': str(fdata['bbox_left']),
+        'bbox_top': str(fdata['bbox_top']),
+        'bbox_width': str(fdata['bbox_width']),
+        'bbox_height': str(fdata['bbox_height']),
+        'imgWidth': str(fdata['imgWidth']),
+        'imgHeight': str(fdata['imgHeight']),
+        'sentiment': fdata['sentiment'],
+        'updated_at': fdata['updated_at'],
+    }
+
+
+class EmotionIndex:
+    """Top size faces of each emotion type by confidence.
+
+    A face is ranked under every emotion it shows with at least
+    min_confidence, by the confidence of that emotion. Items live in DynamoDB
+    under partition key emotion with sort key rank_key, the zero padded
+    confidence followed by the face id, and the face_id-index global
+    secondary index finds the items of a face. Writers
+    read the current top keys of an emotion, insert the faces that beat the
+    lowest of them and delete what falls out of the top, so every emotion
+    holds about size items, concurrent writers can leave it a little over.
+    Items expire after ttl seconds so old faces make way for new ones.
+    """
+
+    FACE_INDEX = 'face_id-index'
+
+    def __init__(self, table_name, size=100, ttl=7 * 86400, min_confidence=50.0, dynamodb=None):
+        self.table = (dynamodb or boto3.resource('dynamodb')).Table(table_name)
+        self.size = size
+        self.ttl = ttl
+        self.min_confidence = min_confidence
+
+    def _top_keys(self, emotion):
+        response = self.table.query(
+            KeyConditionExpression=Key('emotion').eq(emotion),
+            ProjectionExpression='rank_key',
+            ScanIndexForward=False,
+            Limit=self.size
+        )
+        return [item['rank_key'] for item in response['Items']]
+
+    def add(self, records):
+        """Index the faces of records, returns the number of items written."""
+        candidates = {}
+        for fdata in records:
+            for emotion in fdata['emotions']:
+                if emotion['Confidence'] >= self.min_confidence:
+                    candidates.setdefault(emotion['Type'], []).append((_rank_key(emotion['Confidence'], fdata['face_id']), fdata, emotion))
+
+        written = 0
+        expire_at = int(time.time()) + self.ttl
+        for etype, faces in candidates.items():
+            top = self._top_keys(etype)
+            faces = sorted(faces, key=lambda face: face[0], reverse=True)[:self.size]
+            if len(top) == self.size:
+                faces = [face for face in faces if face[0] > top[-1]]
+            if not faces:
+                continue
+            ranked = sorted(top + [face[0] for face in faces], reverse=True)
+            evicted = [rank_key for rank_key in ranked[self.size:] if rank_key in top]
+            with self.table.batch_writer() as batch:
+                for rank_key, fdata, emotion in faces:
+                    if rank_key in ranked[:self.size]:
+                        item = face_item(fdata, emotion)
+                        item.update({'emotion': etype, 'rank_key': rank_key, 'expire_at': expire_at})
+                        batch.put_item(Item=item)
+                        written += 1
+                for rank_key in evicted:
+                    batch.delete_item(Key={'emotion': etype, 'rank_key': rank_key})
+        return written
+
+    def sample(self, emotion):
+        """Return a random face of the top of an emotion, or None when there is none."""
+        response = self.table.query(
+            KeyConditionExpression=Key('emotion').eq(emotion),
+            ScanIndexForward=False,
+            Limit=self.size
+        )
+        now = time.time()
+        # expired items linger until DynamoDB removes them
+        items = [item for item in response['Items'] if item.get('expire_at', now + 1) > now]
+        if not items:
+            return None
+        item = dict(random.choice(items))
+        for key in ('emotion', 'rank_key', 'expire_at'):
+            item.pop(key, None)
+        return item
+
+    def remove(self, face_id):
+        """Delete every item of a face, wherever it ranks."""
+        kwargs = {'IndexName': self.FACE_INDEX, 'KeyConditionExpression': Key('face_id').eq(face_id)}
+        while True:
+            response = self.table.query(**kwargs)
+            for item in response['Items']:
+                self.table.delete_item(Key={'emotion': item['emotion'], 'rank_key': item['rank_key']})
+            if 'LastEvaluatedKey' not in response:
+                return
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
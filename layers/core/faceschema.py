@@ -0,0 +1,58 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import json
+
+# Version of the face records passed from the Rekognition step to ProcessFaces.
+#   0: full Rekognition FaceDetails, the step output data is a JSON string
+#   1: only the fields below, the step output data is an object
+#   2: facerecords too large to pass inline are stored in S3, the data then
+#      holds their key in facerecords_key instead
+SCHEMA_VERSION = 2
+
+# Emotion types of Rekognition DetectFaces, each has an emotion_<type> column
+# in the face records written by ProcessFaces.
+EMOTION_TYPES = ('HAPPY', 'SAD', 'ANGRY', 'CONFUSED', 'DISGUSTED', 'SURPRISED', 'CALM', 'FEAR', 'UNKNOWN')
+
+
+def project_face(face):
+    """Keep the FaceDetails fields read by ProcessFaces."""
+    return {
+        'Confidence': round(face['Confidence'], 3),
+        'Gender': {'Value': face['Gender']['Value'], 'Confidence': round(face['Gender']['Confidence'], 3)},
+        'Emotions': [{'Type': e['Type'], 'Confidence': round(e['Confidence'], 3)} for e in face['Emotions']],
+        'AgeRange': {'Low': face['AgeRange']['Low'], 'High': face['AgeRange']['High']},
+        'BoundingBox': {k: round(v, 5) for k, v in face['BoundingBox'].items()},
+    }
+
+
+def project_faces(face_details):
+    return [project_face(face) for face in face_details]
+
+
+def load(data, fetch=None):
+    """Return the Rekognition step data of any supported version as a dict.
+
+    fetch returns the bytes stored under a facerecords_key, it is needed for
+    the data of images with many faces.
+    """
+    if isinstance(data, str):
+        data = json.loads(data)
+    version = data.get('schema', 0)
+    if version > SCHEMA_VERSION:
+        raise ValueError('Unsupported face record schema version {}'.format(version))
+    if 'facerecords_key' in data:
+        data = dict(data, facerecords=json.loads(fetch(data['facerecords_key'])))
+    return data
+
+
+def flatten_emotions(emotions):
+    """Return the dominant emotion and per emotion confidence columns of a face record."""
+    columns = {'emotion_' + etype.lower(): None for etype in EMOTION_TYPES}
+    dominant = None
+    for e in emotions:
+        columns['emotion_' + e['Type'].lower()] = e['Confidence']
+        if dominant is None or e['Confidence'] > dominant['Confidence']:
+            dominant = e
+    columns['dominant_emotion'] = dominant['Type'] if dominant else None
+    columns['dominant_confidence'] = dominant['Confidence'] if dominant else None
+    return columns
@@ -0,0 +1,143 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import logging
+import struct
+
+import requests
+
+logger = logging.getLogger()
+
+PROBE_BYTES = 16384
+
+# JPEG start of frame markers, C4 (DHT), C8 (JPG) and CC (DAC) are not frames
+_JPEG_SOF = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+_JPEG_APP1 = 0xE1
+_EXIF_ORIENTATION = 0x0112
+
+def probe(url, nbytes=PROBE_BYTES, timeout=5):
+    """Read the first bytes of an image url and return its format, size and length.
+
+    Uses a Range request so only the header is transferred. Returns None when
+    the header could not be read or parsed.
+    """
+    try:
+        r = requests.get(url, headers={'Range': 'bytes=0-%d' % (nbytes - 1)}, stream=True, timeout=timeout)
+        with r:
+            r.raise_for_status()
+            head = b''
+            for chunk in r.iter_content(4096):
+                head += chunk
+                if len(head) >= nbytes:
+                    break
+            length = _content_length(r)
+    except requests.RequestException as e:
+        logger.warning("Probe of %s failed: %s", url, e)
+        return None
+
+    info = parse_header(head)
+    if info is None:
+        return None
+    info['bytes'] = length
+    return info
+
+
+def _content_length(r):
+    content_range = r.headers.get('Content-Range', '')
+    if '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        return int(total) if total.isdigit() else None
+    length = r.headers.get('Content-Length')
+    return int(length) if length and length.isdigit() else None
+
+
+def parse_header(data):
+    """Return {'format', 'width', 'height'} parsed from the leading bytes of an image.
+
+    The size of a JPEG is the upright size after its EXIF orientation, as
+    the analysis sees it.
+    """
+    try:
+        if data[:8] == b'\x89PNG\r\n\x1a\n' and data[12:16] == b'IHDR':
+            width, height = struct.unpack('>II', data[16:24])
+            return {'format': 'PNG', 'width': width, 'height': height}
+        if data[:6] in (b'GIF87a', b'GIF89a'):
+            width, height = struct.unpack('<HH', data[6:10])
+            return {'format': 'GIF', 'width': width, 'height': height}
+        if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+            return _parse_webp(data)
+        if data[:2] == b'\xff\xd8':
+            return _parse_jpeg(data)
+    except struct.error:
+        pass
+    return None
+
+
+def _parse_webp(data):
+    chunk = data[12:16]
+    if chunk == b'VP8 ':
+        width, height = struct.unpack('<HH', data[26:30])
+        return {'format': 'WEBP', 'width': width & 0x3FFF, 'height': height & 0x3FFF}
+    if chunk == b'VP8L':
+        bits = struct.unpack('<I', data[21:25])[0]
+        return {'format': 'WEBP', 'width': (bits & 0x3FFF) + 1, 'height': ((bits >> 14) & 0x3FFF) + 1}
+    if chunk == b'VP8X':
+        width = int.from_bytes(data[24:27], 'little') + 1
+        height = int.from_bytes(data[27:30], 'little') + 1
+        return {'format': 'WEBP', 'width': width, 'height': height}
+    return None
+
+
+def _exif_orientation(segment):
+    """Return the orientation tag of an APP1 Exif segment, 1 when absent, None when unreadable."""
+    if segment[:6] != b'Exif\x00\x00':
+        return 1
+    tiff = segment[6:]
+    if tiff[:2] == b'II':
+        order = '<'
+    elif tiff[:2] == b'MM':
+        order = '>'
+    else:
+        return None
+    offset = struct.unpack(order + 'I', tiff[4:8])[0]
+    count = struct.unpack(order + 'H', tiff[offset:offset + 2])[0]
+    for entry in range(offset + 2, offset + 2 + 12 * count, 12):
+        tag = struct.unpack(order + 'H', tiff[entry:entry + 2])[0]
+        if tag == _EXIF_ORIENTATION:
+            return struct.unpack(order + 'H', tiff[entry + 8:entry + 10])[0]
+    return 1
+
+
+def _parse_jpeg(data):
+    orientation = 1
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # fill byte
+            i += 1
+            continue
+        if marker in _JPEG_SOF:
+            if orientation is None:
+                # the upright width is unknown, let the analysis decide
+                return None
+            height, width = struct.unpack('>HH', data[i + 5:i + 9])
+            if orientation in (5, 6, 7, 8):
+                # stored on its side, displayed rotated by 90 degrees
+                width, height = height, width
+            return {'format': 'JPEG', 'width': width, 'height': height}
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # standalone markers carry no length
+            i += 2
+            continue
+        length = struct.unpack('>H', data[i + 2:i + 4])[0]
+        if marker == _JPEG_APP1 and orientation == 1:
+            try:
+                orientation = _exif_orientation(data[i + 4:i + 2 + length])
+            except struct.error:
+                # IFD0 is past the probed bytes
+                orientation = None
+        i += 2 + length
+    # frame header is past the probed bytes, e.g. behind a large EXIF thumbnail
+    return None
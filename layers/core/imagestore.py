@@ -0,0 +1,50 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import hashlib
+import logging
+
+import boto3
+import requests
+
+logger = logging.getLogger()
+
+class ImageStore:
+    """Content addressed store for downloaded images shared by the analysis stages.
+
+    Images are kept under prefix keyed by the sha256 of their bytes, so the
+    same picture posted under several urls is stored once. The bucket
+    lifecycle rule on the prefix expires them.
+    """
+
+    def __init__(self, bucket, prefix='cache/images/', s3=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3 = s3 or boto3.client('s3')
+
+    def key(self, content):
+        return self.prefix + hashlib.sha256(content).hexdigest()
+
+    def put(self, content):
+        """Store the image bytes and return their key.
+
+        Writing the same content again rewrites the same object, which is
+        cheaper than checking for it first.
+        """
+        key = self.key(content)
+        self.s3.put_object(
+            ACL='private',
+            Body=content,
+            Bucket=self.bucket,
+            Key=key
+        )
+        return key
+
+    def get(self, key):
+        return self.s3.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+
+def download(url):
+    """Download an image from its source url."""
+    r = requests.get(url, allow_redirects=True)
+    r.raise_for_status()
+    return r.content
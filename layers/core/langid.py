@@ -0,0 +1,308 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import math
+import re
+import unicodedata
+from collections import Counter
+
+# Short everyday samples the character trigram profiles are built from. Only
+# the languages Comprehend sentiment supports are identified locally, any
+# other text is left to Comprehend.
+SAMPLES = {
+    'en': (
+        "what a beautiful day, we went to the beach with my friends and it was "
+        "amazing. i can't believe how fast this year is going. thank you all for "
+        "the birthday wishes, love you so much! just finished my first marathon "
+        "and i am so tired but happy. this is the best coffee in town, you should "
+        "try it. happy weekend everyone, have fun and stay safe. my sister and i "
+        "are having dinner tonight with the family. look at this selfie from the "
+        "concert last night, the band was incredible. it is raining again but we "
+        "still have a good time. new haircut, what do you think about it? they "
+        "said that the weather would be better tomorrow. there is nothing like "
+        "home after a long trip. which one do you like more?"
+    ),
+    'es': (
+        "qué día tan bonito, fuimos a la playa con mis amigos y fue increíble. "
+        "no puedo creer lo rápido que pasa este año. gracias a todos por los "
+        "mensajes de cumpleaños, los quiero mucho! acabo de terminar mi primera "
+        "maratón y estoy muy cansada pero feliz. este es el mejor café de la "
+        "ciudad, tienes que probarlo. feliz fin de semana a todos, que se "
+        "diviertan. mi hermana y yo vamos a cenar esta noche con la familia. "
+        "miren esta foto del concierto de anoche, el grupo estuvo genial. está "
+        "lloviendo otra vez pero lo pasamos bien. nuevo corte de pelo, qué "
+        "opinan? dijeron que mañana el tiempo sería mejor. no hay nada como "
+        "estar en casa después de un viaje largo. cuál les gusta más?"
+    ),
+    'pt': (
+        "que dia lindo, fomos à praia com os meus amigos e foi incrível. não "
+        "acredito como este ano está passando rápido. obrigado a todos pelas "
+        "mensagens de aniversário, amo muito vocês! acabei de terminar a minha "
+        "primeira maratona e estou muito cansada mas feliz. este é o melhor café "
+        "da cidade, você precisa experimentar. bom fim de semana a todos, "
+        "divirtam-se. eu e a minha irmã vamos jantar hoje à noite com a família. "
+        "olhem essa foto do show de ontem, a banda estava demais. está chovendo "
+        "de novo mas a gente se divertiu. cabelo novo, o que vocês acham? "
+        "disseram que amanhã o tempo vai ser melhor. não há nada como voltar "
+        "para casa depois de uma viagem longa. qual vocês preferem?"
+    ),
+    'fr': (
+        "quelle belle journée, nous sommes allés à la plage avec mes amis et "
+        "c'était génial. je n'arrive pas à croire que cette année passe si vite. "
+        "merci à tous pour les messages d'anniversaire, je vous aime tellement! "
+        "je viens de finir mon premier marathon et je suis très fatiguée mais "
+        "heureuse. c'est le meilleur café de la ville, il faut absolument "
+        "l'essayer. bon week-end à tous, amusez-vous bien. ma sœur et moi "
+        "dînons ce soir avec la famille. regardez ce selfie du concert d'hier "
+        "soir, le groupe était incroyable. il pleut encore mais on s'amuse "
+        "quand même. nouvelle coupe de cheveux, qu'est-ce que vous en pensez? "
+        "ils ont dit qu'il ferait plus beau demain. rien ne vaut la maison "
+        "après un long voyage. lequel préférez-vous?"
+    ),
+    'de': (
+        "was für ein schöner tag, wir waren mit meinen freunden am strand und es "
+        "war großartig. ich kann nicht glauben, wie schnell dieses jahr vergeht. "
+        "danke euch allen für die geburtstagswünsche, ich hab euch so lieb! ich "
+        "habe gerade meinen ersten marathon beendet und bin sehr müde, aber "
+        "glücklich. das ist der beste kaffee der stadt, den müsst ihr "
+        "probieren. schönes wochenende euch allen, viel spaß. meine schwester "
+        "und ich essen heute abend mit der familie. schaut euch dieses selfie "
+        "vom konzert gestern abend an, die band war unglaublich. es regnet "
+        "schon wieder, aber wir haben trotzdem spaß. neue frisur, was meint "
+        "ihr dazu? sie haben gesagt, dass das wetter morgen besser wird. nichts "
+        "geht über zuhause nach einer langen reise. welches gefällt euch mehr?"
+    ),
+    'it': (
+        "che bella giornata, siamo andati al mare con i miei amici ed è stato "
+        "fantastico. non posso credere quanto velocemente stia passando "
+        "quest'anno. grazie a tutti per gli auguri di compleanno, vi voglio "
+        "tanto bene! ho appena finito la mia prima maratona e sono molto stanca "
+        "ma felice. questo è il caffè migliore della città, dovete provarlo. "
+        "buon fine settimana a tutti, divertitevi. io e mia sorella stasera "
+        "ceniamo con la famiglia. guardate questo selfie del concerto di ieri "
+        "sera, il gruppo era incredibile. piove di nuovo ma ci divertiamo lo "
+        "stesso. nuovo taglio di capelli, cosa ne pensate? hanno detto che "
+        "domani il tempo sarà migliore. non c'è niente come tornare a casa "
+        "dopo un lungo viaggio. quale vi piace di più?"
+    ),
+}
+
+# Most frequent function words of the profiled languages and of the languages
+# of shared scripts. Close relatives share trigrams with a profile or a script
+# but rarely its function words, so these tell Dutch, Danish or Swedish text
+# from German, Tagalog from English, or Persian from Arabic.
+STOPWORDS = {
+    'en': (
+        "the a an and or but of to in on at for with from by about is are was "
+        "were be been am i you he she it we they me my your his her our their "
+        "this that these those there here not no so just what which who how do "
+        "does did have has had will would can could all up out if then than too very"
+    ),
+    'es': (
+        "el la los las un una unos unas y o pero de del a al en con por para es "
+        "son está están fue ser soy estoy que qué como cómo mi mis tu tus su sus "
+        "nos me te se lo le les no sí muy más ya hoy este esta esto ese esa todo "
+        "todos yo tú él ella hay"
+    ),
+    'pt': (
+        "o a os as um uma e ou mas de do da dos das em no na nos nas com por para "
+        "é são está estão foi ser sou estou que como meu minha meus minhas seu sua "
+        "você vocês eu ele ela nós não sim muito mais já hoje este esta isso essa "
+        "tudo todos tem"
+    ),
+    'fr': (
+        "le la les l un une des et ou mais de du d à au aux en dans avec pour par "
+        "sur est sont était suis c ce cette ces que qu qui je j tu il elle on nous "
+        "vous ils me m te t se s mon ma mes ton ta tes son sa ses notre nos votre "
+        "vos ne n pas plus très tout tous y"
+    ),
+    'de': (
+        "der die das den dem des ein eine einen einem einer und oder aber zu im "
+        "in am an auf mit von für bei aus ist sind war waren bin bist hat haben "
+        "habe ich du er sie es wir ihr mich mir dich dir uns euch mein meine "
+        "meinen meines dein deine unser unsere nicht kein keine so sehr noch "
+        "schon auch wie was wo dass heute immer nach"
+    ),
+    'it': (
+        "il lo la i gli le l un una uno e o ma di del della dei delle a al alla in "
+        "nel nella con per su è sono era che chi io tu lui lei noi voi mi ti ci si "
+        "vi mio mia miei mie tuo tua suo sua non più molto già oggi questo questa "
+        "tutto tutti ho ha hanno"
+    ),
+    'ar': (
+        "في من على إلى الى عن مع هذا هذه ذلك تلك التي الذي الذين هو هي هم أنا انا "
+        "نحن أنت انت كان كانت كل لا ما لم لن قد و يا بعد قبل عند حتى أو او ثم إن "
+        "أن ان اليوم جدا كثيرا لقد مثل"
+    ),
+    'hi': (
+        "है हैं था थी थे का की के को में से पर और या भी नहीं यह ये वह वो मैं हम "
+        "तुम आप एक हो तो ही कि जो कर रहा रही रहे लिए साथ बहुत आज अब गया गई गए"
+    ),
+}
+
+# Function words of languages that are not identified locally but share a
+# script with one that is, text with more of them than of the identified
+# language is left to Comprehend.
+OTHER_STOPWORDS = {
+    'nl': "de het een en of maar van in op met voor naar bij is zijn was ik je jij hij zij we wij ze niet geen ook nog wel wat dat die dit",
+    'da': "og i en et det den de er var jeg du han hun vi ikke med til på af for som har fra men så min mit mine",
+    'sv': "och i en ett det den de är var jag du han hon vi inte med till på av för som har från men så min mitt mina",
+    'ca': "el la els les un una i o però de del a al en amb per és són va ser que com meu meva nostre nostra aquest aquesta no molt més tot",
+    'tl': "ang ng mga sa at na ay ako ko ikaw ka siya kami tayo sila ito iyan hindi may para kay",
+    'id': "yang dan di ke dari ini itu dengan untuk pada aku saya kamu dia kami kita mereka tidak ada akan sudah sangat",
+    'tr': "bir ve bu şu o ben sen biz siz onlar için ile çok da de ne gibi daha en var yok ama",
+    'pl': "i w z na do nie się że jest to ten ta jak ale od po dla mój moja nasz jestem był była",
+    'ro': "și în cu la pe de din o un este sunt am ai a fost nu mai ce care pentru meu mea noastră",
+    'fa': "و در به از که این آن با را است هست بود برای تا هم یک من ما تو شما او ها می خیلی امروز نه شد",
+    'ur': "ہے ہیں تھا تھی تھے کا کی کے کو میں سے پر اور یا بھی نہیں یہ وہ ہم آپ ایک ہو تو کہ جو کر لیے ساتھ بہت آج",
+    'mr': "आहे आहेत होता होती होते आणि व ते तो ती मी आम्ही तुम्ही खूप मध्ये ला ने चा ची चे नाही पण हे आज काय",
+    'ne': "छ छन् थियो थिए र पनि मा बाट लाई म हामी तिमी यो त्यो धेरै छैन गर्न भयो हो साथीहरू",
+}
+
+# scripts of the supported languages
+SCRIPTS = (
+    ('HANGUL', 'ko'),
+    ('HIRAGANA', 'ja'),
+    ('KATAKANA', 'ja'),
+    ('ARABIC', 'ar'),
+    ('DEVANAGARI', 'hi'),
+)
+# scripts also written by languages Comprehend sentiment does not support,
+# Persian and Urdu or Marathi and Nepali, their text is checked for function words
+SHARED_SCRIPTS = {'ar', 'hi'}
+
+# cosine similarity below which a text is unlike every profiled language
+MIN_SIMILARITY = 0.2
+# share of function words of the identified language in a typical text, with
+# less than half of it the text is likely another language spelled alike
+STOPWORD_SHARE = 0.25
+
+_NOISE = re.compile(r'https?://\S+|[@#]\w+|\d+')
+_NON_LETTER = re.compile(r"[^\w']+|_")
+
+
+def _trigrams(text):
+    counts = Counter()
+    for word in _NON_LETTER.sub(' ', text.lower()).split():
+        padded = ' ' + word + ' '
+        for i in range(len(padded) - 2):
+            counts[padded[i:i + 3]] += 1
+    return counts
+
+
+def _profile(text):
+    counts = _trigrams(text)
+    norm = math.sqrt(sum(c * c for c in counts.values()))
+    return {gram: c / norm for gram, c in counts.items()}
+
+
+PROFILES = {language: _profile(sample) for language, sample in SAMPLES.items()}
+STOPWORD_SETS = {language: frozenset(words.split()) for language, words in STOPWORDS.items()}
+OTHER_STOPWORD_SETS = {language: frozenset(words.split()) for language, words in OTHER_STOPWORDS.items()}
+
+
+def _words(text):
+    # vowel signs of Devanagari are marks, not word characters, and elided
+    # articles and pronouns such as l' or c' count as words
+    return ''.join(
+        ch if ch.isalnum() or unicodedata.category(ch).startswith('M') else ' '
+        for ch in text.lower()
+    ).split()
+
+
+def _stopword_shares(text, stopword_sets):
+    words = _words(text)
+    if not words:
+        return {language: 0.0 for language in stopword_sets}
+    return {
+        language: sum(word in stopwords for word in words) / len(words)
+        for language, stopwords in stopword_sets.items()
+    }
+
+
+def _function_words(text, language):
+    """Return how far the function words of text vouch for language, in [0, 1].
+
+    0 when they are less than half the usual share or fewer than those of a
+    language of OTHER_STOPWORDS.
+    """
+    own = _stopword_shares(text, {language: STOPWORD_SETS[language]})[language]
+    if own < STOPWORD_SHARE / 2 or any(
+            other > own for other in _stopword_shares(text, OTHER_STOPWORD_SETS).values()):
+        return 0.0
+    return min(1.0, own / STOPWORD_SHARE)
+
+
+def _script(text):
+    """Return the language of a script only used by one supported language, or None."""
+    letters = [ch for ch in text if ch.isalpha()]
+    if not letters:
+        return None, 0.0
+    names = Counter()
+    for ch in letters:
+        if ord(ch) < 0x250:
+            names['LATIN'] += 1
+            continue
+        name = unicodedata.name(ch, '')
+        for script, language in SCRIPTS:
+            if name.startswith(script):
+                names[language] += 1
+                break
+        else:
+            if name.startswith('CJK'):
+                names['CJK'] += 1
+    if not names:
+        return None, 0.0
+    script, count = names.most_common(1)[0]
+    share = count / len(letters)
+    if names['ja'] and script == 'CJK':
+        # kanji with some kana is Japanese
+        script = 'ja'
+    return script, share
+
+
+def identify(text):
+    """Return (language, confidence) of a tweet text.
+
+    Confidence is in [0, 1]: the share of letters in the script for script
+    identified languages, and for Latin script text the margin between the
+    two closest trigram profiles, scaled down for short texts. Both are
+    scaled down for texts with few function words of the identified language
+    when the script is shared with other languages. Text whose best trigram
+    similarity is below MIN_SIMILARITY, with less than half the usual share
+    of function words, or with more function words of a language of
+    OTHER_STOPWORDS has confidence 0: it is most likely in a language that
+    is not identified locally.
+    """
+    text = _NOISE.sub(' ', text)
+    script, share = _script(text)
+    if script is None:
+        return 'en', 0.0
+    if script == 'CJK':
+        # Chinese or Traditional Chinese, left to Comprehend
+        return 'zh', 0.0
+    if script in SHARED_SCRIPTS:
+        return script, share * _function_words(text, script)
+    if script != 'LATIN':
+        return script, share
+
+    counts = _trigrams(text)
+    total = sum(counts.values())
+    if not total:
+        return 'en', 0.0
+    norm = math.sqrt(sum(c * c for c in counts.values()))
+    scores = sorted(
+        ((sum(c * profile.get(gram, 0.0) for gram, c in counts.items()) / norm, language)
+         for language, profile in PROFILES.items()),
+        reverse=True
+    )
+    (best, language), (second, _) = scores[0], scores[1]
+    if best < MIN_SIMILARITY:
+        return language, 0.0
+    # a relative of the language shares its trigrams but not its function words
+    words = _function_words(text, language)
+    if not words:
+        return language, 0.0
+    margin = (best - second) / best
+    # about 60 trigrams, a dozen words, are needed for a reliable margin
+    confidence = margin * min(1.0, total / 60.0) * words * share
+    return language, min(1.0, confidence * 4)
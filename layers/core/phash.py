@@ -0,0 +1,105 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import json
+import logging
+import time
+
+import boto3
+
+logger = logging.getLogger()
+
+def dhash(image):
+    """Return the 64 bit difference hash of a PIL image."""
+    small = image.convert('L').resize((9, 8))
+    px = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return bits
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class PhashIndex:
+    """Near duplicate image index on 64 bit perceptual hashes.
+
+    Uses multi-index hashing: every hash is split into max_distance + 1
+    chunks and stored in DynamoDB under each of them (partition key bucket,
+    sort key phash). Two hashes within Hamming distance max_distance share at
+    least one chunk, so querying the buckets of a hash finds all of its
+    neighbours up to that distance. The default distance 3 gives four 16 bit
+    chunks. The analysis result of an indexed image is kept in S3 under
+    prefix.
+    """
+
+    # chunks narrower than 4 bits hold too many hashes per bucket to query
+    MAX_CHUNKS = 16
+
+    def __init__(self, table_name, bucket, prefix='cache/faces/', max_distance=3, ttl=86400, dynamodb=None, s3=None):
+        if not 0 <= max_distance < self.MAX_CHUNKS:
+            raise ValueError('max_distance must be between 0 and %d' % (self.MAX_CHUNKS - 1))
+        self.table = (dynamodb or boto3.resource('dynamodb')).Table(table_name)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.s3 = s3 or boto3.client('s3')
+        # (shift, width) of each chunk, the first 64 % chunks chunks get a bit more
+        chunks = max_distance + 1
+        self.chunks = []
+        shift = 0
+        for i in range(chunks):
+            width = 64 // chunks + (1 if i < 64 % chunks else 0)
+            self.chunks.append((shift, width))
+            shift += width
+
+    def _buckets(self, h):
+        return ['%d#%0*x' % (i, (width + 3) // 4, (h >> shift) & ((1 << width) - 1))
+                for i, (shift, width) in enumerate(self.chunks)]
+
+    def lookup(self, h):
+        """Return (distance, result) of the closest indexed image within max_distance, or None."""
+        best = None
+        for bucket in self._buckets(h):
+            kwargs = {
+                'KeyConditionExpression': '#b = :b',
+                'ExpressionAttributeNames': {'#b': 'bucket'},
+                'ExpressionAttributeValues': {':b': bucket},
+                'ProjectionExpression': 'phash, result_key'
+            }
+            # a popular chunk value spans several pages, all of them are candidates
+            while True:
+                response = self.table.query(**kwargs)
+                for item in response['Items']:
+                    distance = hamming(h, int(item['phash'], 16))
+                    if distance <= self.max_distance and (best is None or distance < best[0]):
+                        best = (distance, item)
+                if 'LastEvaluatedKey' not in response:
+                    break
+                kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        if best is None:
+            return None
+        try:
+            body = self.s3.get_object(Bucket=self.bucket, Key=best[1]['result_key'])['Body'].read()
+        except self.s3.exceptions.NoSuchKey:
+            # result expired before the index entry
+            return None
+        return best[0], json.loads(body)
+
+    def add(self, h, result):
+        """Index the analysis result of an image with hash h."""
+        phash = '%016x' % h
+        key = self.prefix + phash + '.json'
+        self.s3.put_object(
+            ACL='private',
+            Body=json.dumps(result),
+            Bucket=self.bucket,
+            Key=key
+        )
+        expire_at = int(time.time()) + self.ttl
+        with self.table.batch_writer() as batch:
+            for bucket in self._buckets(h):
+                batch.put_item(Item={'bucket': bucket, 'phash': phash, 'result_key': key, 'expire_at': expire_at})
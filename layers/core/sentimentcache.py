@@ -0,0 +1,127 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import hashlib
+import logging
+import random
+import re
+import time
+
+import boto3
+
+from cache import LRUCache
+
+logger = logging.getLogger()
+
+_RETWEET = re.compile(r'^rt @\w+:\s*')
+_URL = re.compile(r'https?://\S+')
+_SPACE = re.compile(r'\s+')
+
+def normalize(text):
+    """Drop what differs between copies of the same text: case, retweet prefix, links and spacing."""
+    text = _RETWEET.sub('', text.lower())
+    text = _URL.sub('', text)
+    return _SPACE.sub(' ', text).strip()
+
+
+def text_key(text):
+    return hashlib.sha256(normalize(text).encode('utf-8')).hexdigest()
+
+
+class SentimentCache:
+    """Language and sentiment of tweet texts, keyed by normalized text hash.
+
+    Lookups go to an in-memory LRU of the warm container first, then to the
+    DynamoDB table (partition key text_hash) whose items expire after ttl
+    seconds.
+    """
+
+    BATCH_GET_LIMIT = 100
+    BATCH_GET_ATTEMPTS = 4
+    BATCH_GET_BACKOFF = 0.05
+
+    def __init__(self, table_name, maxsize=10000, ttl=7 * 86400, dynamodb=None):
+        self.dynamodb = dynamodb or boto3.resource('dynamodb')
+        self.table = self.dynamodb.Table(table_name) if table_name else None
+        self.memory = LRUCache(maxsize)
+        self.ttl = ttl
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.memory_hits = 0
+        self.table_hits = 0
+        self.misses = 0
+
+    def get_many(self, texts):
+        """Return {text: (language, sentiment)} for the cached texts."""
+        found = {}
+        keys = {}
+        for text in texts:
+            key = text_key(text)
+            cached = self.memory.get(key)
+            if cached is not None:
+                found[text] = cached
+                self.memory_hits += 1
+            else:
+                keys.setdefault(key, []).append(text)
+
+        if self.table is not None and keys:
+            pending = list(keys)
+            for i in range(0, len(pending), self.BATCH_GET_LIMIT):
+                for item in self._batch_get(pending[i:i + self.BATCH_GET_LIMIT]):
+                    value = (item['language'], item['sentiment'])
+                    self.memory.put(item['text_hash'], value)
+                    for text in keys[item['text_hash']]:
+                        found[text] = value
+                        self.table_hits += 1
+
+        self.misses += len(texts) - len(found)
+        return found
+
+    def _batch_get(self, keys):
+        request = {self.table.name: {'Keys': [{'text_hash': key} for key in keys]}}
+        items = []
+        try:
+            for attempt in range(self.BATCH_GET_ATTEMPTS):
+                if attempt:
+                    # unprocessed keys mean the table is throttled, back off with full jitter
+                    time.sleep(random.uniform(0, self.BATCH_GET_BACKOFF * 2 ** attempt))
+                response = self.dynamodb.batch_get_item(RequestItems=request)
+                items.extend(response['Responses'].get(self.table.name, []))
+                request = response.get('UnprocessedKeys')
+                if not request:
+                    break
+            else:
+                # the cache is an optimisation, the keys left are misses
+                logger.warning('Sentiment cache lookup gave up on %d keys', len(request[self.table.name]['Keys']))
+        except Exception as e:
+            # the cache is an optimisation, a failed lookup is a miss
+            logger.error('Sentiment cache lookup failed: ' + str(e))
+        return items
+
+    def put_many(self, entries):
+        """Cache {text: (language, sentiment)} in memory and in the table."""
+        expire_at = int(time.time()) + self.ttl
+        items = {}
+        for text, (language, sentiment) in entries.items():
+            key = text_key(text)
+            self.memory.put(key, (language, sentiment))
+            items[key] = {'text_hash': key, 'language': language, 'sentiment': sentiment, 'expire_at': expire_at}
+
+        if self.table is None or not items:
+            return
+        try:
+            with self.table.batch_writer() as batch:
+                for item in items.values():
+                    batch.put_item(Item=item)
+        except Exception as e:
+            logger.error('Sentiment cache write failed: ' + str(e))
+
+    def publish(self, metrics):
+        """Put the hits and misses since the last publish as EMF metrics."""
+        lookups = self.memory_hits + self.table_hits + self.misses
+        if lookups:
+            metrics.put_metric("SentimentCacheMemoryHits", self.memory_hits, "Count")
+            metrics.put_metric("SentimentCacheTableHits", self.table_hits, "Count")
+            metrics.put_metric("SentimentCacheMisses", self.misses, "Count")
+            metrics.put_metric("SentimentCacheHitRate", 100.0 * (lookups - self.misses) / lookups, "Percent")
+        self.reset_stats()
@@ -0,0 +1,157 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import logging
+import random
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+logger = logging.getLogger()
+
+THROTTLING_ERRORS = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'LimitExceededException',
+}
+
+# transient service side errors, retried like botocore standard retries do
+TRANSIENT_ERRORS = {
+    'InternalFailure',
+    'InternalServerError',
+    'InternalServerException',
+    'ServiceUnavailable',
+    'ServiceUnavailableException',
+    'RequestTimeout',
+    'RequestTimeoutException',
+}
+
+# clients whose retries, throttling and transient errors alike, are left to RateLimiter.call
+NO_RETRY_CONFIG = Config(retries={'mode': 'standard', 'max_attempts': 1})
+
+
+class RateLimiter:
+    """Client side token bucket for one API, with jittered retries of throttled calls.
+
+    Calls are spaced to at most rate per second with bursts of up to burst
+    calls. Throttling errors, 5xx and transient service errors and connection
+    errors are retried with full jitter exponential backoff, any other error
+    is raised at once. When table_name is set, each
+    call also takes a slot from a per-second counter in that DynamoDB table,
+    so that all containers together stay under rate, which must then be at
+    least 1. The stats are shared by all threads using the limiter.
+    """
+
+    def __init__(self, name, rate, burst=None, max_retries=5, base_delay=0.1, max_delay=5.0, table_name=None, dynamodb=None):
+        if table_name and rate < 1:
+            raise ValueError('Shared rate limit of %s needs a rate of at least 1 per second, got %s' % (name, rate))
+        self.name = name
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.table = (dynamodb or boto3.resource('dynamodb')).Table(table_name) if table_name else None
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.calls = 0
+        self.throttles = 0
+        self.wait_ms = 0.0
+
+    def _count(self, calls=0, throttles=0, wait_ms=0.0):
+        with self._stats_lock:
+            self.calls += calls
+            self.throttles += throttles
+            self.wait_ms += wait_ms
+
+    def acquire(self):
+        """Block until a call may be made."""
+        waited = 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens < 0:
+                waited = -self._tokens / self.rate
+        if waited:
+            time.sleep(waited)
+        if self.table:
+            waited += self._acquire_shared()
+        self._count(wait_ms=waited * 1000)
+
+    def _acquire_shared(self):
+        waited = 0.0
+        while True:
+            now = time.time()
+            second = int(now)
+            try:
+                self.table.update_item(
+                    Key={'id': '%s#%d' % (self.name, second)},
+                    UpdateExpression='ADD calls :one SET expire_at = :expire_at',
+                    ConditionExpression='attribute_not_exists(calls) OR calls < :rate',
+                    ExpressionAttributeValues={':one': 1, ':rate': int(self.rate), ':expire_at': second + 60}
+                )
+                return waited
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    # coordination is best effort, fall back to the local bucket
+                    logger.warning("Shared rate limit for %s unavailable: %s", self.name, e)
+                    return waited
+            delay = second + 1 - now + random.uniform(0, 0.05)
+            time.sleep(delay)
+            waited += delay
+
+    def call(self, fn, **kwargs):
+        """Call fn(**kwargs) within the rate, retrying throttling and transient errors."""
+        attempt = 0
+        while True:
+            self.acquire()
+            self._count(calls=1)
+            try:
+                return fn(**kwargs)
+            except ClientError as e:
+                code = e.response['Error']['Code']
+                status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+                if code in THROTTLING_ERRORS:
+                    self._count(throttles=1)
+                    reason = 'throttled'
+                elif code in TRANSIENT_ERRORS or status >= 500:
+                    reason = code
+                else:
+                    raise
+                if attempt >= self.max_retries:
+                    raise
+            except (ConnectionError, HTTPClientError) as e:
+                # connection resets and read timeouts
+                if attempt >= self.max_retries:
+                    raise
+                reason = type(e).__name__
+            attempt += 1
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * pow(2, attempt)))
+            logger.info("%s %s, retry %d in %.2f s", self.name, reason, attempt, delay)
+            time.sleep(delay)
+            self._count(wait_ms=delay * 1000)
+
+    def publish(self, metrics):
+        """Put the throttle count and wait time since the last publish as EMF metrics.
+
+        Publish once per invocation, after the calls of all its threads.
+        """
+        with self._stats_lock:
+            calls, throttles, wait_ms = self.calls, self.throttles, self.wait_ms
+            self.reset_stats()
+        if calls:
+            metrics.put_metric(self.name + "Throttles", throttles, "Count")
+            metrics.put_metric(self.name + "ThrottleWait", wait_ms, "Milliseconds")
@@ -0,0 +1,28 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+from concurrent.futures import ThreadPoolExecutor
+
+from aws_xray_sdk.core import xray_recorder
+
+
+def traced(fn):
+    """Wrap fn to run under the X-Ray trace entity of the calling thread.
+
+    Worker threads start without a trace entity, subsegments they open would
+    otherwise be lost.
+    """
+    entity = xray_recorder.get_trace_entity()
+
+    def call(*args, **kwargs):
+        xray_recorder.set_trace_entity(entity)
+        return fn(*args, **kwargs)
+
+    return call
+
+
+def parallel(fn, items, workers):
+    """Map fn over items from a thread pool, keeping the X-Ray trace of the caller."""
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as pool:
+        return list(pool.map(traced(fn), items))
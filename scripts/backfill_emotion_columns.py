@@ -0,0 +1,184 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Adds the dominant_emotion, dominant_confidence and emotion_<type> columns to
+# face records written before processFaces produced them.
+#
+#   json-records: every object under data/json-records/ (single records and
+#   ndjson chunks, gzip or not) is rewritten in place with the columns added.
+#
+#   parquet: each parquet_records file without the columns is re-written by
+#   an Athena UNLOAD that computes them from the emotions array. The new files
+#   are copied next to it as <file>-backfill-<n>, which keeps the Firehose
+#   name and timestamp delImage looks files up by, and the old file is deleted
+#   right after. A file that still exists on a rerun has its copies replaced,
+#   so an interrupted run leaves no duplicate records behind.
+#
+#   python scripts/backfill_emotion_columns.py --bucket BUCKET [--database DB] [--parquet] [--dry-run]
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import boto3
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'layers', 'core'))
+
+from faceschema import EMOTION_TYPES, flatten_emotions
+
+JSON_PREFIX = 'data/json-records/'
+UNLOAD_PREFIX = 'data/backfill-tmp/'
+UNLOAD_CONCURRENCY = 4
+
+s3 = boto3.client('s3')
+athena = boto3.client('athena')
+glue = boto3.client('glue')
+
+
+def backfill_object(bucket, key, dry_run):
+    """Add the columns to the records of one object, returns the number of records changed."""
+    body = s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+    compressed = key.endswith('.gz')
+    if compressed:
+        body = gzip.decompress(body)
+
+    changed = 0
+    lines = []
+    for line in body.decode('utf-8').splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if 'dominant_emotion' not in record:
+            record.update(flatten_emotions(record.get('emotions') or []))
+            changed += 1
+        lines.append(json.dumps(record))
+
+    if changed and not dry_run:
+        body = ('\n'.join(lines) + '\n').encode('utf-8')
+        s3.put_object(ACL='private', Bucket=bucket, Key=key, Body=gzip.compress(body) if compressed else body)
+    return changed
+
+
+def backfill_json(bucket, dry_run, workers):
+    keys = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=JSON_PREFIX):
+        keys.extend(item['Key'] for item in page.get('Contents', []))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        changed = sum(pool.map(lambda key: backfill_object(bucket, key, dry_run), keys))
+    print('json-records: %d objects, %d records %s' % (len(keys), changed, 'to backfill' if dry_run else 'backfilled'))
+
+
+def run_query(query, database, output):
+    query_id = athena.start_query_execution(
+        QueryString=query,
+        QueryExecutionContext={'Database': database},
+        ResultConfiguration={'OutputLocation': output}
+    )['QueryExecutionId']
+    delay = 0.5
+    while True:
+        status = athena.get_query_execution(QueryExecutionId=query_id)['QueryExecution']['Status']
+        if status['State'] == 'SUCCEEDED':
+            return query_id
+        if status['State'] in ('FAILED', 'CANCELLED'):
+            raise Exception('Athena query failed: ' + status.get('StateChangeReason', query))
+        time.sleep(delay)
+        delay = min(delay * 2, 5)
+
+
+def query_rows(query, database, output):
+    query_id = run_query(query, database, output)
+    rows = []
+    for page in athena.get_paginator('get_query_results').paginate(QueryExecutionId=query_id):
+        rows.extend([col.get('VarCharValue') for col in row['Data']] for row in page['ResultSet']['Rows'])
+    return rows[1:]
+
+
+def column_expressions(columns):
+    """Select list of parquet_records with the flattened columns computed from emotions."""
+    dominant = ("reduce(emotions, CAST(NULL AS ROW(type VARCHAR, confidence DOUBLE)), "
+                "(s, e) -> IF(s IS NULL OR e.confidence > s.confidence, e, s), s -> s)")
+    computed = {
+        'dominant_emotion': dominant + '.type',
+        'dominant_confidence': dominant + '.confidence',
+    }
+    for etype in EMOTION_TYPES:
+        computed['emotion_' + etype.lower()] = \
+            "element_at(filter(emotions, e -> e.type = '%s'), 1).confidence" % etype
+    return ', '.join('%s AS %s' % (computed[name], name) if name in computed else name for name in columns)
+
+
+def list_keys(bucket, prefix):
+    keys = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        keys.extend(item['Key'] for item in page.get('Contents', []))
+    return keys
+
+
+def backfill_file(path, bucket, database, output, columns, staging):
+    """Replace one parquet file by copies with the columns added."""
+    source = urlparse(path)
+    source_key = source.path.lstrip('/')
+    # copies left by an interrupted run may be incomplete, the source is the
+    # reference until it is deleted
+    for key in list_keys(source.netloc, source_key + '-backfill-'):
+        s3.delete_object(Bucket=source.netloc, Key=key)
+
+    run_query(
+        "UNLOAD (SELECT %s FROM parquet_records WHERE \"$path\" = '%s') TO 's3://%s/%s' WITH (format = 'PARQUET')" % (
+            column_expressions(columns), path, bucket, staging),
+        database, output)
+
+    staged = list_keys(bucket, staging)
+    for n, key in enumerate(staged):
+        s3.copy_object(
+            Bucket=source.netloc,
+            Key='%s-backfill-%d' % (source_key, n),
+            CopySource={'Bucket': bucket, 'Key': key}
+        )
+    s3.delete_object(Bucket=source.netloc, Key=source_key)
+    for key in staged:
+        s3.delete_object(Bucket=bucket, Key=key)
+
+
+def backfill_parquet(bucket, database, output, dry_run):
+    table = glue.get_table(DatabaseName=database, Name='parquet_records')['Table']
+    columns = [column['Name'] for column in table['StorageDescriptor']['Columns']]
+
+    paths = [row[0] for row in query_rows(
+        'SELECT DISTINCT "$path" FROM parquet_records WHERE dominant_emotion IS NULL', database, output)]
+    print('parquet_records: %d files without the emotion columns' % len(paths))
+    if dry_run or not paths:
+        return
+
+    run = uuid.uuid4().hex[:8]
+    with ThreadPoolExecutor(max_workers=UNLOAD_CONCURRENCY) as pool:
+        list(pool.map(
+            lambda item: backfill_file(item[1], bucket, database, output, columns, UNLOAD_PREFIX + run + '/%d/' % item[0]),
+            enumerate(paths)))
+    print('parquet_records: rewrote %d files' % len(paths))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bucket', required=True)
+    parser.add_argument('--database', default='twitter-db')
+    parser.add_argument('--output', help='Athena result location, default s3://BUCKET/twitter-ath-results/backfill/')
+    parser.add_argument('--parquet', action='store_true', help='also rewrite the parquet_records files')
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--workers', type=int, default=16)
+    args = parser.parse_args()
+
+    backfill_json(args.bucket, args.dry_run, args.workers)
+    if args.parquet:
+        output = args.output or 's3://%s/twitter-ath-results/backfill/' % args.bucket
+        backfill_parquet(args.bucket, args.database, output, args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Accuracy and latency of the offline language identifier of the core layer
+# on a labelled sample, optionally compared with Comprehend. Texts labelled
+# with a language the identifier does not support must stay below the
+# threshold, a local decision on them is wrong. Exits 1 on wrong decisions.
+#
+#   python scripts/langid_benchmark.py [--threshold 0.5] [--comprehend]
+import argparse
+import csv
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'layers', 'core'))
+
+import langid
+
+SAMPLE = os.path.join(os.path.dirname(__file__), 'langid_sample.tsv')
+SUPPORTED = set(langid.SAMPLES) | {language for script, language in langid.SCRIPTS}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sample', default=SAMPLE)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--comprehend', action='store_true', help='also time Comprehend detect_dominant_language')
+    args = parser.parse_args()
+
+    with open(args.sample, encoding='utf-8') as f:
+        rows = list(csv.DictReader(f, delimiter='\t'))
+
+    local = correct = wrong = unsupported = 0
+    started = time.perf_counter()
+    for row in rows:
+        language, confidence = langid.identify(row['text'])
+        if row['language'] not in SUPPORTED:
+            unsupported += 1
+        if confidence < args.threshold:
+            continue
+        local += 1
+        if language == row['language']:
+            correct += 1
+        else:
+            wrong += 1
+            print('wrong: %s as %s (%.2f) %s' % (row['language'], language, confidence, row['text']))
+    elapsed = time.perf_counter() - started
+
+    print('texts: %d (%d in unsupported languages), decided locally: %d (%.0f%%), correct: %d, wrong: %d' % (
+        len(rows), unsupported, local, 100.0 * local / len(rows), correct, wrong))
+    print('local latency: %.1f us per text' % (1e6 * elapsed / len(rows)))
+
+    if args.comprehend:
+        import boto3
+        comprehend = boto3.client('comprehend')
+        correct = 0
+        started = time.perf_counter()
+        for row in rows:
+            languages = comprehend.detect_dominant_language(Text=row['text'])['Languages']
+            if max(languages, key=lambda l: l['Score'])['LanguageCode'] == row['language']:
+                correct += 1
+        elapsed = time.perf_counter() - started
+        print('comprehend: correct: %d of %d, latency: %.1f ms per text' % (
+            correct, len(rows), 1e3 * elapsed / len(rows)))
+
+    if wrong:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()